@@ -1,10 +1,11 @@
 import os
-from flask import Flask, request, redirect, session, render_template_string
+from flask import Flask, request, redirect, session, render_template, abort, g, has_request_context, flash
+from jinja2 import ChoiceLoader, DictLoader, FileSystemLoader
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import RequestEntityTooLarge
 from openpyxl import load_workbook
 from pathlib import Path
 from reportlab.pdfgen import canvas
-from flask import send_file
 import io
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.lib.units import mm
@@ -14,35 +15,152 @@ from reportlab.pdfbase.pdfmetrics import stringWidth
 import uuid
 from tempfile import gettempdir
 import random
+from bisect import bisect_left, bisect_right
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from types import SimpleNamespace
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import hmac
+import gzip
+import mimetypes
+import json
+import mmap
+import select
+import ctypes
+import stat
+import struct
+import sys
+from array import array
+import click
+import time
 import psycopg2
 import os
 from contextlib import contextmanager
 import psycopg2, os
-from psycopg2.pool import SimpleConnectionPool
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+from psycopg2.extras import execute_values
 from contextlib import contextmanager
 import os
 from psycopg2.errors import UniqueViolation
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
+try:
+    import fcntl
+except ImportError:    # Windows（開発用）ではプロセス間のロックなし
+    fcntl = None
+
+
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# 1ワーカーあたりの接続数（gunicorn.conf.py が DB_MAX_CONNECTIONS をワーカー数で割って決める）。
+# 起動時に開くのは DB_POOL_MIN 本だけで、残りは使うときに開く
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 4))
+DB_POOL_MIN = min(int(os.environ.get("DB_POOL_MIN", 1)), DB_POOL_MAX)
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+# この秒数より長く使われていなかった接続は、貸す前に SELECT 1 で確かめる
+DB_POOL_PING_AFTER = float(os.environ.get("DB_POOL_PING_AFTER", 30))
+
+# プールは fork 後のワーカーごとに作る（gunicorn の master では作らない）
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_conn_last_used = {}
+
+
+def get_pool():
+    global _pool, _pool_pid, _pool_slots
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadedConnectionPool(
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    dsn=os.environ["DATABASE_URL"]
+                )
+                # psycopg2 のプールは minconn 本を超えて返された接続を閉じてしまうので、
+                # 開いた後は max 本まで手元に残して使い回す
+                _pool.minconn = DB_POOL_MAX
+                # 空きがなければエラーにせず待たせる
+                _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                _conn_last_used.clear()
+                _pool_pid = os.getpid()
+    return _pool, _pool_slots
+
+
+def _checkout(pool):
+    # Postgres の再起動などで切れた接続は捨てて取り直す
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        last_used = _conn_last_used.pop(id(conn), None)
+        if conn.closed or conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+            pool.putconn(conn, close=True)
+            stat_add("db_pool_discarded_total")
+            continue
+        if last_used is not None and time.monotonic() - last_used > DB_POOL_PING_AFTER:
+            stat_add("db_pool_pings_total")
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                pool.putconn(conn, close=True)
+                stat_add("db_pool_discarded_total")
+                continue
+        return conn
+    raise PoolError("no healthy connection available")
 
-DATABASE_URL = os.environ["DATABASE_URL"]
-
-pool = SimpleConnectionPool(
-    minconn=1,
-    maxconn=10,
-    dsn=DATABASE_URL
-)
 
 @contextmanager
 def get_db():
-    conn = pool.getconn()
+    pool, slots = get_pool()
+
+    t_phase = time.perf_counter()
+    t0 = time.monotonic()
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        stat_add("db_pool_timeouts_total")
+        raise PoolError("connection pool exhausted")
+    stat_add("db_pool_wait_seconds_total", time.monotonic() - t0)
+    stat_add("db_pool_checkouts_total")
+
+    try:
+        conn = _checkout(pool)
+    except Exception:
+        slots.release()
+        raise
+
+    gauge_add("db_pool_in_use", 1)
     cur = conn.cursor()
+    broken = False
     try:
         yield cur
         conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
     finally:
-        cur.close()
-        pool.putconn(conn)
+        try:
+            cur.close()
+        except psycopg2.Error:
+            broken = True
+        broken = broken or conn.closed
+        if not broken:
+            _conn_last_used[id(conn)] = time.monotonic()
+        else:
+            stat_add("db_pool_discarded_total")
+        pool.putconn(conn, close=broken)
+        gauge_add("db_pool_in_use", -1)
+        slots.release()
+        phase_add("db", time.perf_counter() - t_phase)
 
 
 # ===== 日本語フォント =====
@@ -62,9 +180,523 @@ app.secret_key = os.environ.get("SECRET_KEY", "dev-secret")
 
 EXCEL_PATH = Path("英単語テスト.xlsx")  # ← あなたの単語Excelに合わせてOK
 
+# リクエスト本文の上限（管理画面からの単語帳アップロードもこの大きさまで）
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_CONTENT_LENGTH", 8 * 1024 * 1024))
+
 TMPDIR = Path(gettempdir()) / "word_test"
 TMPDIR.mkdir(exist_ok=True)
 
+# /generate_batch で1回に作れる部数の上限
+MAX_BATCH_COPIES = int(os.environ.get("MAX_BATCH_COPIES", 60))
+
+# PDF描画を任せるプロセス数（0 ならリクエストのスレッドで描く）と、
+# 描画中＋待ちの上限・待ち時間の上限
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 2))
+PDF_QUEUE_LIMIT = int(os.environ.get("PDF_QUEUE_LIMIT", 8))
+PDF_TIMEOUT = float(os.environ.get("PDF_TIMEOUT", 30))
+PDF_RETRY_AFTER = int(os.environ.get("PDF_RETRY_AFTER", 5))
+
+
+
+def private_dir(path):
+    # 中身を信用して読むディレクトリ（単語帳バイナリ・メトリクス・PDF キャッシュ）。
+    # /tmp のような共有の場所で他のユーザーが先に作っていると、偽の単語帳などを
+    # 置かれてしまうので、自分だけが書けるディレクトリでなければ使わない
+    path = Path(path)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    st = path.stat()
+    if not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError(f"{path} がディレクトリではありません")
+    if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+        raise RuntimeError(f"{path} は自分だけが書けるディレクトリにしてください（所有者・パーミッション）")
+    return path
+
+
+# Excel をコンパイルした単語帳バイナリの置き場所（ワーカー間で共有）
+WORDBANK_DIR = private_dir(os.environ.get("WORDBANK_DIR") or Path(app.instance_path) / "wordbank")
+
+
+# ===== 簡易メトリクス（ワーカーごとの累計と、現在値） =====
+_stats = {}
+_gauges = {}
+_stats_lock = threading.Lock()
+
+
+def stat_add(name, value=1):
+    with _stats_lock:
+        _stats[name] = _stats.get(name, 0) + value
+
+
+def gauge_set(name, value):
+    with _stats_lock:
+        _gauges[name] = value
+
+
+def gauge_add(name, value):
+    with _stats_lock:
+        _gauges[name] = _gauges.get(name, 0) + value
+
+
+def stats_snapshot():
+    with _stats_lock:
+        return {**_stats, **_gauges}
+
+
+# ===== リクエストの所要時間（Prometheus 形式で /metrics に出す） =====
+# リクエスト全体と、その内訳（単語帳・抽選・描画・DB など）をヒストグラムにする。
+# gunicorn ではワーカーが複数あり /metrics はどれか1つに届くので、
+# 各ワーカーは METRICS_DIR に自分の値を時々書き出し、/metrics は全ワーカー分を足す
+METRICS_DIR = private_dir(os.environ.get("METRICS_DIR") or Path(app.instance_path) / "metrics")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+# Prometheus から取りに来るときは Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# この秒数より古いワーカーのファイルの現在値（gauge）は出さない
+METRICS_GAUGE_STALE = float(os.environ.get("METRICS_GAUGE_STALE", 60))
+
+_hists = {}
+_metrics_flush_lock = threading.Lock()
+_metrics_flushed = 0.0
+
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    i = bisect_left(METRICS_BUCKETS, seconds)
+    with _stats_lock:
+        h = _hists.get(key)
+        if h is None:
+            h = _hists[key] = [[0] * (len(METRICS_BUCKETS) + 1), 0.0]
+        h[0][i] += 1
+        h[1] += seconds
+
+
+def phase_add(phase, seconds):
+    # リクエストの外（起動時の読み込み・別スレッド）では数えない
+    if has_request_context():
+        phases = g.setdefault("phases", {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_add(phase, time.perf_counter() - t0)
+
+
+@app.before_request
+def start_timer():
+    g.t_start = time.perf_counter()
+
+
+@app.after_request
+def record_timing(res):
+    # after_request は登録の逆順に呼ばれるので、圧縮の時間も含む
+    t_start = g.get("t_start")
+    if t_start is None:
+        return res
+    elapsed = time.perf_counter() - t_start
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    observe("wordtest_request_seconds", elapsed,
+            endpoint=endpoint, method=request.method, status=str(res.status_code))
+    for phase, seconds in g.get("phases", {}).items():
+        observe("wordtest_phase_seconds", seconds, endpoint=endpoint, phase=phase)
+    # シートは読み込めたときだけ routes が g.sheet に入れる（ラベルが増えすぎないように）
+    sheet = g.get("sheet")
+    if sheet is not None:
+        observe("wordtest_sheet_seconds", elapsed, endpoint=endpoint, sheet=sheet)
+    flush_metrics()
+    return res
+
+
+def flush_metrics(force=False):
+    global _metrics_flushed
+    if not force and time.monotonic() - _metrics_flushed < METRICS_FLUSH_INTERVAL:
+        return
+    if not _metrics_flush_lock.acquire(blocking=force):
+        return
+    try:
+        _metrics_flushed = time.monotonic()
+        with _stats_lock:
+            data = {
+                "stats": dict(_stats),
+                "gauges": dict(_gauges),
+                "hists": [[name, labels, h[0][:], h[1]] for (name, labels), h in _hists.items()],
+            }
+        METRICS_DIR.mkdir(parents=True, exist_ok=True)
+        path = METRICS_DIR / f"{os.getpid()}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError:
+        stat_add("metrics_flush_errors_total")
+    finally:
+        _metrics_flush_lock.release()
+
+
+def clean_metrics_dir():
+    # 前回の起動の値を足さないように、ワーカーを起動する前に消す
+    for p in METRICS_DIR.glob("*.json"):
+        try:
+            p.unlink()
+        except OSError:
+            pass
+
+
+def reset_metrics():
+    # fork 直後のワーカーで呼ぶ。master が起動時に数えた分を引き継ぐと、
+    # ワーカーの数だけ重ねて足されてしまう
+    global _metrics_flushed
+    with _stats_lock:
+        _stats.clear()
+        _gauges.clear()
+        _hists.clear()
+    _metrics_flushed = 0.0
+
+
+def _merge_metrics(stats, hists, data):
+    for name, v in data["stats"].items():
+        stats[name] = stats.get(name, 0) + v
+    for name, labels, counts, total in data["hists"]:
+        key = (name, tuple(map(tuple, labels)))
+        h = hists.setdefault(key, [[0] * (len(METRICS_BUCKETS) + 1), 0.0])
+        for i, n in enumerate(counts):
+            h[0][i] += n
+        h[1] += total
+
+
+def archive_worker_metrics(pid):
+    # 終わったワーカーの累計を archive.json に足し込み、<pid>.json は消す
+    # （gunicorn の master が child_exit で1つずつ呼ぶので、同時には書かれない）
+    path = METRICS_DIR / f"{pid}.json"
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        path.unlink(missing_ok=True)
+        return
+    archive = METRICS_DIR / "archive.json"
+    stats, hists = {}, {}
+    try:
+        _merge_metrics(stats, hists, json.loads(archive.read_text(encoding="utf-8")))
+    except (OSError, ValueError):
+        pass
+    _merge_metrics(stats, hists, data)
+    merged = {
+        "stats": stats,
+        "hists": [[name, labels, h[0], h[1]] for (name, labels), h in hists.items()],
+    }
+    tmp = archive.with_suffix(".tmp")
+    tmp.write_text(json.dumps(merged, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, archive)
+    path.unlink(missing_ok=True)
+
+
+def _label_value(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in pairs) + "}"
+
+
+def render_metrics():
+    flush_metrics(force=True)
+    stats = {}
+    gauges = {}
+    hists = {}
+    now = time.time()
+    # 動いているワーカーの <pid>.json と、終わったワーカーの分をまとめた archive.json を足す
+    for p in METRICS_DIR.glob("*.json"):
+        try:
+            mtime = p.stat().st_mtime
+            data = json.loads(p.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        _merge_metrics(stats, hists, data)
+        # 現在値は足さずにワーカーごとに出す。しばらく書かれていないワーカーは除く
+        if now - mtime < METRICS_GAUGE_STALE:
+            for name, v in data.get("gauges", {}).items():
+                gauges.setdefault(name, []).append((p.stem, v))
+
+    lines = []
+    for name in sorted(stats):
+        metric = f"wordtest_{name}"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {stats[name]}")
+
+    for name in sorted(gauges):
+        metric = f"wordtest_{name}"
+        lines.append(f"# TYPE {metric} gauge")
+        for pid, v in sorted(gauges[name]):
+            lines.append(f'{metric}{{pid="{pid}"}} {v}')
+
+    typed = set()
+    for (name, labels), (counts, total) in sorted(hists.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cum = 0
+        for le, n in zip(METRICS_BUCKETS + ("+Inf",), counts):
+            cum += n
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cum}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cum}")
+    return "\n".join(lines) + "\n"
+
+
+# 以前のバージョンが TMPDIR に残したPDFを片付ける
+def clean_tmpdir():
+    for p in TMPDIR.glob("*_final.pdf"):
+        try:
+            size = p.stat().st_size
+            p.unlink()
+        except OSError:
+            continue
+        stat_add("tmpdir_files_removed_total")
+        stat_add("tmpdir_bytes_removed_total", size)
+
+
+clean_tmpdir()
+
+
+# ===== ログイン用のユーザーキャッシュ =====
+# 授業開始時のログイン集中で同じ SELECT を繰り返さないよう、短時間だけ覚える。
+# 管理画面での承認・削除・リセット時に消す（他ワーカーの分は TTL で切れる）
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 10))
+USER_CACHE_MAX = 10000
+
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+
+def find_user(username):
+    now = time.monotonic()
+    hit = _user_cache.get(username)
+    if hit is not None and hit[0] > now:
+        stat_add("user_cache_hits_total")
+        return hit[1]
+
+    stat_add("user_cache_misses_total")
+    with get_db() as cur:
+        cur.execute(
+            "SELECT id, username, password_hash, role, approved FROM users WHERE username=%s",
+            (username,)
+        )
+        user = cur.fetchone()
+
+    with _user_cache_lock:
+        if len(_user_cache) >= USER_CACHE_MAX:
+            _user_cache.clear()
+        _user_cache[username] = (now + USER_CACHE_TTL, user)
+    return user
+
+
+def invalidate_user_cache(username=None):
+    with _user_cache_lock:
+        if username is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(username, None)
+
+
+# ===== パスワードのハッシュ計算 =====
+# ハッシュ計算は重いので同時に走る数を HASH_WORKERS に抑え、
+# 待ちが HASH_QUEUE_LIMIT を超えたら 503 で断る
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", 2))
+HASH_QUEUE_LIMIT = int(os.environ.get("HASH_QUEUE_LIMIT", 32))
+HASH_TIMEOUT = float(os.environ.get("HASH_TIMEOUT", 10))
+
+
+class HashBusy(Exception):
+    pass
+
+
+_hash_pool = None
+_hash_pool_pid = None
+_hash_slots = None
+_hash_pool_lock = threading.Lock()
+
+
+def _get_hash_pool():
+    global _hash_pool, _hash_pool_pid, _hash_slots
+    if _hash_pool_pid != os.getpid():
+        with _hash_pool_lock:
+            if _hash_pool_pid != os.getpid():
+                _hash_pool = ThreadPoolExecutor(
+                    max_workers=HASH_WORKERS, thread_name_prefix="pwhash"
+                )
+                _hash_slots = threading.BoundedSemaphore(HASH_QUEUE_LIMIT)
+                _hash_pool_pid = os.getpid()
+    return _hash_pool, _hash_slots
+
+
+def _run_hash(fn, *args):
+    pool, slots = _get_hash_pool()
+    if not slots.acquire(blocking=False):
+        stat_add("hash_rejected_total")
+        raise HashBusy()
+    try:
+        fut = pool.submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    fut.add_done_callback(lambda f: slots.release())
+    try:
+        with timed("hash"):
+            return fut.result(timeout=HASH_TIMEOUT)
+    except FuturesTimeout:
+        stat_add("hash_timeouts_total")
+        raise HashBusy()
+
+
+def verify_password(pwhash, password):
+    return _run_hash(check_password_hash, pwhash, password)
+
+
+def hash_password(password):
+    return _run_hash(generate_password_hash, password)
+
+
+# ===== スキーマ移行 =====
+# 移行より前に必ず流す土台（既存DBでは何もしない）
+SCHEMA_BOOTSTRAP = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id            serial PRIMARY KEY,
+        username      text NOT NULL,
+        password_hash text NOT NULL,
+        role          text NOT NULL DEFAULT 'student',
+        approved      boolean NOT NULL DEFAULT false
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version    integer PRIMARY KEY,
+        name       text NOT NULL,
+        applied_at timestamptz NOT NULL DEFAULT now()
+    )
+    """,
+]
+
+# (番号, 内容, SQL)。適用済みの番号は schema_migrations に記録する。
+# 一度出したものは書き換えず、末尾に足していくこと
+MIGRATIONS = [
+    (1, "users.username の一意インデックス", [
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_username_key ON users (username)",
+    ]),
+    (2, "users(role, approved) のインデックス（管理画面・承認待ち一覧）", [
+        "CREATE INDEX IF NOT EXISTS users_role_approved_idx ON users (role, approved)",
+    ]),
+    (3, "単語帳テーブル words と取り込み情報 wordbank_meta", [
+        """
+        CREATE TABLE IF NOT EXISTS words (
+            sheet text    NOT NULL,
+            num   bigint  NOT NULL,
+            pos   integer NOT NULL,
+            q     text    NOT NULL,
+            a     text    NOT NULL
+        )
+        """,
+        # 範囲の取り出しは (sheet, num) で引き、同じ番号は Excel の行順（pos）に並べる
+        "CREATE INDEX IF NOT EXISTS words_sheet_num_idx ON words (sheet, num, pos)",
+        """
+        CREATE TABLE IF NOT EXISTS wordbank_meta (
+            version     text   NOT NULL,
+            sheetnames  text[] NOT NULL,
+            imported_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    (4, "取り込んだシートごとの sha256（変わったシートだけ入れ替える）", [
+        """
+        CREATE TABLE IF NOT EXISTS wordbank_sheets (
+            sheet  text PRIMARY KEY,
+            sha256 text NOT NULL
+        )
+        """,
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# 複数ワーカーが同時に流しても1回だけ適用されるようにするロック番号
+MIGRATION_LOCK_ID = 19_0001
+
+
+def schema_version(cur):
+    cur.execute("SELECT to_regclass('schema_migrations')")
+    if cur.fetchone()[0] is None:
+        return 0
+    cur.execute("SELECT coalesce(max(version), 0) FROM schema_migrations")
+    return cur.fetchone()[0]
+
+
+def migrate():
+    applied = []
+    with get_db() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+        for sql in SCHEMA_BOOTSTRAP:
+            cur.execute(sql)
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {r[0] for r in cur.fetchall()}
+
+        for version, name, statements in MIGRATIONS:
+            if version in done:
+                continue
+            for sql in statements:
+                cur.execute(sql)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (version, name)
+            )
+            applied.append((version, name))
+    return applied
+
+
+_schema_checked_pid = None
+
+
+def ensure_schema():
+    # ワーカーごとに1回だけ、バージョンを比べて知らせるだけ（DDL は流さない）。
+    # 移行はデプロイ時に flask db-migrate で行う（.render.yaml の startCommand）。
+    # 確かめられなくても済んだことにして、ログインなどのリクエストは止めない
+    global _schema_checked_pid
+    if _schema_checked_pid == os.getpid():
+        return
+    _schema_checked_pid = os.getpid()
+    try:
+        with get_db() as cur:
+            current = schema_version(cur)
+    except Exception as e:
+        print(f"⚠ スキーマのバージョンを確かめられません: {e!r}")
+        return
+    if current < SCHEMA_VERSION:
+        print(f"⚠ スキーマが古いです（{current} < {SCHEMA_VERSION}）。flask db-migrate を実行してください")
+
+
+@app.cli.command("db-migrate")
+def db_migrate_command():
+    """未適用のスキーマ移行を適用する。"""
+    applied = migrate()
+    for version, name in applied:
+        click.echo(f"applied {version}: {name}")
+    if not applied:
+        click.echo("schema is up to date")
+
+
+@app.cli.command("db-status")
+def db_status_command():
+    """適用済みのスキーマのバージョンを表示する。"""
+    with get_db() as cur:
+        current = schema_version(cur)
+    click.echo(f"schema version {current} (latest {SCHEMA_VERSION})")
+    for version, name, _ in MIGRATIONS:
+        if version > current:
+            click.echo(f"pending {version}: {name}")
+
 
 # -------------------------
 # HTML（templates無し）
@@ -329,6 +961,20 @@ button:hover {
     <button type="button" onclick="doPdf()">印刷用</button>
   </div>
 
+  <div class="row">
+    <label>部数（クラス分印刷）</label>
+    <input id="copies" type="number" min="1" value="30">
+  </div>
+
+  <div class="row">
+    <button type="button" onclick="doBatchPdf()">クラス分印刷（並びを変えて部数分）</button>
+  </div>
+
+  <div class="row" id="reprintRow" style="display:none">
+    <div class="note" id="reprintNote"></div>
+    <button type="button" onclick="reprint()">同じ並びでもう一度印刷</button>
+  </div>
+
   <div class="row">
     <button type="button" onclick="doHtml()">テスト</button>
   </div>
@@ -346,13 +992,14 @@ function getParams(){
   return {sheet, start, end};
 }
 
-async function doPdf(){
-  const p = getParams();
-  if(!p) return;
+// 最後に作ったPDFの送り先と中身（X-Test-Seed を足して送ると同じ並びになり、
+// サーバーのキャッシュからすぐ返ってくる）
+let lastPdf = null;
 
+async function openPdf(path, p){
   const win = window.open("about:blank");
 
-  const res = await fetch("/generate", {
+  const res = await fetch(path, {
     method: "POST",
     headers: {"Content-Type": "application/json"},
     body: JSON.stringify(p)
@@ -364,12 +1011,38 @@ async function doPdf(){
     return;
   }
 
+  const seed = res.headers.get("X-Test-Seed");
+  if(seed){
+    lastPdf = {path, p: {...p, seed}};
+    document.getElementById('reprintNote').textContent =
+      `前回：${p.sheet} ${p.start}〜${p.end}` + (p.copies ? `（${p.copies}部）` : "");
+    document.getElementById('reprintRow').style.display = "";
+  }
+
   // ★ ここが重要（URLを使わないPDF表示）
   const blob = await res.blob();
   const url = URL.createObjectURL(blob);
   win.location.href = url;
 }
 
+async function doPdf(){
+  const p = getParams();
+  if(!p) return;
+  await openPdf("/generate", p);
+}
+
+async function doBatchPdf(){
+  const p = getParams();
+  if(!p) return;
+  p.copies = document.getElementById('copies').value;
+  await openPdf("/generate_batch", p);
+}
+
+async function reprint(){
+  if(!lastPdf) return;
+  await openPdf(lastPdf.path, lastPdf.p);
+}
+
 async function doHtml(){
   const p = getParams();
   if(!p) return;
@@ -416,710 +1089,106 @@ HTML_TEST_TEMPLATE = """
       content="width=device-width, initial-scale=1.0, user-scalable=no">
 
 
-<style>
-/* ===== HTMLテスト画面だけ ===== */
-.html-test {
-  margin: 0;
-  padding: 0;
-  background: #fff;
-}
-
-.html-test #print-root {
-  background: #fff;
-  margin: 0;
-
-  padding-top: 40px;     /* ← 上は少しだけ */
-  padding-left: 60px;    /* ← 左は少し小さく */
-  padding-right: 340px;  /* ← 右は少し広め */
-  padding-bottom: 80px;  /* ← 下は今のまま */
-
-  max-width: none;
-  box-shadow: none;
-}
+<link rel="stylesheet" href="{{ asset_url('html_test.css') }}">
 
+</head>
 
+<body class="html-test">
 
+<!-- ===== 固定UIレイヤー（ズーム非影響） ===== -->
+<div id="ui-layer">
+  <div class="toolbar">
+    <button onclick="toggleAll()">解答</button>
+    <button onclick="setColor('black')">⚫黒</button>
+    <button onclick="setColor('red')">🔴赤</button>
+    <button onclick="setMode('eraser')">🧽消</button>
+    <button onclick="clearAll()">🗑全消</button>
+    <button onclick="window.print()">🖨印刷</button>
+  </div>
+</div>
 
+<!-- ===== 描画・ズームレイヤー ===== -->
+  <div id="scroll-layer">
+   <div id="content-layer">
+    <div id="print-root">
 
-/* ===== 画面では canvas をはみ出させない ===== */
-.html-test canvas {
-  max-width: 100%;
-  height: auto;
-}
+      <div class="header">
+        <!-- 左側（タイトル） -->
+        <div class="header-left">
+          <h2>shingaku19minato test</h2>
+          <div>words {{sheet}}（{{start}}～{{end}}）</div>
+        </div>
 
+        <!-- 右側（21〜40と同じ列） -->
+        <div class="header-right">
+          name：<canvas width="140" height="28"></canvas>
+          score：<canvas width="140" height="28"></canvas>
+        </div>
+      </div>
 
-html, body {
-  overscroll-behavior: none;
-}
+    {% for i in range(20) %}
+    {% set item  = items[i] %}
+    {% set item2 = items[i+20] %}
 
-/* ===== header：問題と同じ横構造 ===== */
-.header {
-  display: grid;
-  grid-template-columns:
-    44px
-    minmax(220px, 1fr)
-    minmax(120px, 160px)
-    180px
-    44px
-    minmax(220px, 1fr)
-    minmax(120px, 160px)
-    180px
-    20px;
-
-  align-items: start;
-  margin-bottom: 16px;
-}
+    <div class="item">
+    <!-- 左（1〜20） -->
+    <div>{{item.no}}.</div>
+    <div>{{item.q}}</div>
+    <div class="answer" id="ans-{{item.no}}">{{item.a}}</div>
+    <canvas width="160" height="28"></canvas>
 
-/* 左側（タイトル） */
-.header-left {
-  grid-column: 1 / 5;
-}
+    <!-- 右（21〜40） -->
+    <div>{{item2.no}}.</div>
+    <div>{{item2.q}}</div>
+    <div class="answer" id="ans-{{item2.no}}">{{item2.a}}</div>
+    <canvas width="160" height="28"></canvas>
+    </div>
 
-/* 右側（name / score） */
-.header-right {
-  grid-column: 6 / 9;
-  justify-self: end;
+    {% endfor %}
+    <div class="item dummy"></div>
 
-  display: flex;
-  gap: 12px;
-  white-space: nowrap;
-}
+    </div> <!-- print-root -->
+   </div> <!-- content-layer -->
+  </div>     <!-- scroll-layer -->
 
+<script src="{{ asset_url('html_test.js') }}"></script>
 
 
-.header canvas {
-  vertical-align: middle;
-  margin-right: 8px;
-}
 
 
-/* ===== 画面表示用 ===== */
-.item {
-  display: grid;
-  grid-template-columns:
-    44px
-    minmax(220px, 1fr)
-    minmax(120px, 160px)
-    180px
-    44px
-    minmax(220px, 1fr)
-    minmax(120px, 160px)
-    180px
-    20px;   /* ★ 右余白はここだけ */
-
-  padding: 0;           /* ★ 削除 */
-  height: 40px;
-  align-items: center;
-  box-sizing: border-box;
-}
 
+</body>
+</html>
+"""
 
 
-.item.dummy {
-  height: 120px;
+ADMIN_HTML = """
+<!doctype html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<title>管理者</title>
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<style>
+body{
+  font-family: sans-serif;
+  padding: 16px;
+  background: #f5f5f5;
 }
 
-
-
-.answer {
-  min-width: 0;
-  font-weight: bold;
-  color: red;
-  opacity: 0.85;
-
-  visibility: hidden;
-
-  font-size: 11px;
-  line-height: 1.2;
-
-  white-space: normal;
-  word-break: break-word;
-
-  /* ★ここから追加 */
-  display: -webkit-box;
-  -webkit-line-clamp: 2;
-  -webkit-box-orient: vertical;
-  overflow: hidden;
+h2{
+  font-size: 24px;
+  margin-bottom: 12px;
 }
 
-.answer.show {
-  visibility: visible;
+.controls{
+  margin-bottom: 12px;
 }
 
-#right-fixed {
-  position: absolute;
-  top: 0;
-  right: 0;
-  width: 200px;      /* 好きな幅 */
-  text-align: right;
-}
-
-
-
-/* ===== canvas ===== */
-
-canvas {
-  display: block;
-  background: #f2f2f2;
-  border: 1px solid #ccc;
-
-  touch-action: none;     /* ★ canvasだけロック */
-  user-select: none;
-  pointer-events: auto;
-}
-
-.item {
-  user-select: none;      /* 文字選択防止だけ */
-}
-
-/* ★ item * は消す */
-
-.small-text {
-  font-size: 9px;
-  line-height: 1.1;
-}
-
-
-/* ===== 固定UIレイヤー（ズーム非影響） ===== */
-#ui-layer {
-  position: fixed;
-  inset: 0;
-  z-index: 2000;
-  pointer-events: none;   /* ★ 超重要 */
-}
-
-/* toolbarだけ操作可能 */
-#ui-layer .toolbar {
-  pointer-events: auto;
-  position: absolute;
-  top: calc(12px + env(safe-area-inset-top));
-  right: calc(12px + env(safe-area-inset-right));
-}
-
-#content-layer {
-  padding: 60px 160px 120px 80px;
-  /* 上   右    下    左 */
-  box-sizing: border-box;
-}
-
-
-
-/* ===== name / score（ズーム非影響）===== */
-#ui-layer .header-right {
-  position: absolute;
-  top: calc(60px + env(safe-area-inset-top)); /* toolbarの下 */
-  right: calc(20px + env(safe-area-inset-right));
-
-  display: flex;
-  gap: 12px;
-  white-space: nowrap;
-
-  pointer-events: auto;   /* ★ canvasを書けるように */
-}
-
-
-
-
-/* ===== 操作ツールバー ===== */
-.toolbar {
-  top: calc(12px + env(safe-area-inset-top));
-  right: calc(12px + env(safe-area-inset-right));
-  display: flex;
-  gap: 6px;
-  background: rgba(255,255,255,0.95);
-  padding: 4px;
-  border-radius: 8px;
-  box-shadow: 0 2px 8px rgba(0,0,0,.2);
-  z-index: 1000;
-}
-
-.toolbar button {
-  font-size: 10px;
-  padding: 4px 8px;
-  white-space: nowrap; /* 折り返さない */
-}
-
-
-@media (max-width: 900px) {
-  .toolbar {
-    top: auto;
-    bottom: calc(12px + env(safe-area-inset-bottom));
-  }
-}
-
-
-/* 各問題行を横並びにする */
-.word-row {
-  display: flex;
-  align-items: center;
-}
-
-/* 左：問題文 */
-.word-row .question {
-  flex: 1 1 auto;   /* 残り幅を使う */
-  min-width: 0;     /* ★ これが超重要 */
-}
-
-/* 右：canvas */
-.word-row .answer {
-  flex: 0 0 180px;  /* ★ canvas列は固定 */
-}
-
-@media print {
-
-  @page {
-    size: A4 landscape;
-    margin: 15mm;
-  }
-
-  html, body {
-    margin: 0;
-    padding: 0;
-  }
-
-  /* ===== スクロール解除 ===== */
-  #scroll-layer {
-    overflow: visible !important;
-  }
-
-  /* ===== 印刷倍率を固定（★60%）===== */
-  #content-layer {
-    transform: scale(0.60) !important;
-    transform-origin: top left !important;
-
-    width: auto !important;
-    height: auto !important;
-  }
-
-  #print-root {
-    transform: none !important;
-    width: auto !important;
-  }
-
-  canvas {
-    background: #fff;
-  }
-
-  /* ===== UI非表示 ===== */
-  #ui-layer,
-  .toolbar,
-  button {
-    display: none !important;
-  }
-}
-
-
-
-/* ===== スクロール担当レイヤー ===== */
-html, body {
-  margin: 0;
-  padding: 0;
-  height: 100%;
-  overflow: hidden; /* bodyのスクロールを殺す */
-}
-
-#scroll-layer {
-  position: fixed;
-  inset: 0;
-  width: 100vw;
-  height: 100vh;
-  overflow: auto;   /* ← スクロールはここだけ */
-  background:  #fff;
-}
-
-
-
-
-</style>
-</head>
-
-<body class="html-test">
-
-<!-- ===== 固定UIレイヤー（ズーム非影響） ===== -->
-<div id="ui-layer">
-  <div class="toolbar">
-    <button onclick="toggleAll()">解答</button>
-    <button onclick="setColor('black')">⚫黒</button>
-    <button onclick="setColor('red')">🔴赤</button>
-    <button onclick="setMode('eraser')">🧽消</button>
-    <button onclick="clearAll()">🗑全消</button>
-    <button onclick="window.print()">🖨印刷</button>
-  </div>
-</div>
-
-<!-- ===== 描画・ズームレイヤー ===== -->
-  <div id="scroll-layer">
-   <div id="content-layer">
-    <div id="print-root">
-
-      <div class="header">
-        <!-- 左側（タイトル） -->
-        <div class="header-left">
-          <h2>shingaku19minato test</h2>
-          <div>words {{sheet}}（{{start}}～{{end}}）</div>
-        </div>
-
-        <!-- 右側（21〜40と同じ列） -->
-        <div class="header-right">
-          name：<canvas width="140" height="28"></canvas>
-          score：<canvas width="140" height="28"></canvas>
-        </div>
-      </div>
-
-    {% for i in range(20) %}
-    {% set item  = items[i] %}
-    {% set item2 = items[i+20] %}
-
-    <div class="item">
-    <!-- 左（1〜20） -->
-    <div>{{item.no}}.</div>
-    <div>{{item.q}}</div>
-    <div class="answer" id="ans-{{item.no}}">{{item.a}}</div>
-    <canvas width="160" height="28"></canvas>
-
-    <!-- 右（21〜40） -->
-    <div>{{item2.no}}.</div>
-    <div>{{item2.q}}</div>
-    <div class="answer" id="ans-{{item2.no}}">{{item2.a}}</div>
-    <canvas width="160" height="28"></canvas>
-    </div>
-
-    {% endfor %}
-    <div class="item dummy"></div>
-
-    </div> <!-- print-root -->
-   </div> <!-- content-layer -->
-  </div>     <!-- scroll-layer -->
-
-<script>
-
-console.log("content-layer =", document.getElementById("content-layer"));
-
-let mode = "pen";
-let color = "#000";
-
-function setColor(c){
-  color = (c === "red") ? "#d00" : "#000";
-  mode = "pen";
-}
-
-function setMode(m){
-  mode = m;
-}
-
-function clearAll(){
-  document.querySelectorAll("canvas").forEach(c=>{
-    const ctx = c.getContext("2d");
-    ctx.save();
-    ctx.setTransform(1,0,0,1,0,0);  // ← スケール解除
-    ctx.clearRect(0, 0, c.width, c.height);
-    ctx.restore();
-  });
-}
-
-
-function toggleAll(){
-  document.querySelectorAll('.answer')
-    .forEach(a => a.classList.toggle('show'));
-}
-
-
-document.querySelectorAll("canvas").forEach(c => {
-
-  if (window.matchMedia("print").matches) return;
-
-  const ratio = window.devicePixelRatio || 1;
-
-  // ===== ① CSSサイズを保存（テンプレそのまま）=====
-  const cssW = c.width;
-  const cssH = c.height;
-
-  // ===== ② 内部解像度だけ拡大 =====
-  c.width  = cssW * ratio;
-  c.height = cssH * ratio;
-
-  // ===== ③ 見た目サイズは固定 =====
-  c.style.width  = cssW + "px";
-  c.style.height = cssH + "px";
-
-  const ctx = c.getContext("2d");
-
-  // ★ ここが最重要（座標系を元に戻す）
-  ctx.setTransform(ratio, 0, 0, ratio, 0, 0);
-
-
-  let drawing = false;
-
-  ctx.lineWidth = 0.6;        // ← 今まで通りでOK
-  ctx.lineCap = "round";
-  ctx.lineJoin = "round";
-  ctx.strokeStyle = color;
-
-function getPos(e){
-  const rect = c.getBoundingClientRect();
-  return {
-    x: (e.clientX - rect.left) / scale,
-    y: (e.clientY - rect.top ) / scale
-  };
-}
-
-
-  c.addEventListener("touchstart", e=>{
-    e.preventDefault();
-  }, { passive: false });
-
-  c.addEventListener("pointerdown", e=>{
-    e.preventDefault();
-    e.stopPropagation();
-
-    drawing = true;
-    c.setPointerCapture(e.pointerId);
-
-    const p = getPos(e);
-    ctx.beginPath();
-    ctx.moveTo(p.x, p.y);
-  });
-
-  c.addEventListener("pointermove", e=>{
-    if(!drawing) return;
-    e.preventDefault();
-
-    const p = getPos(e);
-
-    if(mode === "eraser"){
-      ctx.clearRect(p.x - 6, p.y - 6, 12, 12);
-    }else{
-      ctx.strokeStyle = color;
-      ctx.lineTo(p.x, p.y);
-      ctx.stroke();
-    }
-  });
-
-  c.addEventListener("pointerup", e=>{
-    drawing = false;
-    c.releasePointerCapture(e.pointerId);
-  });
-
-  c.addEventListener("pointercancel", ()=>{
-    drawing = false;
-  });
-});
-
-
-document.querySelectorAll('.answer, .item > div:nth-child(2), .item > div:nth-child(6)')
-  .forEach(el=>{
-    if(el.textContent.length > 30){
-      el.classList.add('small-text');
-    }
-  });
-  
-/* ===== ピンチズーム（最終安定版）===== */
-const scrollLayer  = document.getElementById("scroll-layer");
-const contentLayer = document.getElementById("content-layer");
-
-let startScale = 1;
-let pinchCenter = { x: 0, y: 0 };
-let scale = 1;
-let startDist = null;
-
-function getDistance(t1, t2){
-  const dx = t1.clientX - t2.clientX;
-  const dy = t1.clientY - t2.clientY;
-  return Math.hypot(dx, dy);
-}
-
-function getCenter(t1, t2){
-  return {
-    x: (t1.clientX + t2.clientX) / 2,
-    y: (t1.clientY + t2.clientY) / 2
-  };
-}
-
-
-
-
-/* scroll-layer 基準で最小倍率を決める */
-function getMinScale(){
-  const vw = scrollLayer.clientWidth;
-  const vh = scrollLayer.clientHeight;
-
-  const rect = document
-    .getElementById("print-root")
-    .getBoundingClientRect();
-
-  const sx = vw / rect.width;
-  const sy = vh / rect.height;
-
-  return Math.min(sx, sy);
-}
-
-
-function applyScale(cx, cy){
-  const rect = contentLayer.getBoundingClientRect();
-
-  const ox = (cx - rect.left + scrollLayer.scrollLeft) / scale;
-  const oy = (cy - rect.top  + scrollLayer.scrollTop ) / scale;
-
-  contentLayer.style.transform = `scale(${scale})`;
-  contentLayer.style.width  = (100 / scale) + "%";
-  contentLayer.style.height = (100 / scale) + "%";
-
-  scrollLayer.scrollLeft = ox * scale - (cx - rect.left);
-  scrollLayer.scrollTop  = oy * scale - (cy - rect.top);
-
-  /* ===== 余白込みでスクロール制限 ===== */
-  const PADDING_RIGHT = 340 * scale;
-  const PADDING_BOTTOM = 120 * scale;
-
-  const minLeft = 0;
-  const minTop  = 0;
-
-  const maxLeft =
-    contentLayer.scrollWidth - scrollLayer.clientWidth + PADDING_RIGHT;
-  const maxTop =
-    contentLayer.scrollHeight - scrollLayer.clientHeight + PADDING_BOTTOM;
-
-  scrollLayer.scrollLeft = Math.min(maxLeft, Math.max(minLeft, scrollLayer.scrollLeft));
-  scrollLayer.scrollTop  = Math.min(maxTop,  Math.max(minTop,  scrollLayer.scrollTop));
-}
-
-// ===== 初期表示（必須）=====
-const INITIAL_SCALE_FACTOR = 0.55;
-
-window.addEventListener("load", () => {
-  scale = getMinScale() * INITIAL_SCALE_FACTOR;
-
-  // ★ 初期表示は transform だけ設定（補正しない）
-  contentLayer.style.transformOrigin = "0 0";
-  contentLayer.style.transform = `scale(${scale})`;
-
-  // ★ スクロールは必ず左上
-  scrollLayer.scrollLeft = 0;
-  scrollLayer.scrollTop  = 0;
-});
-
-
-
-// ===== 印刷時スケール制御 =====
-let savedScale = 1;
-
-window.addEventListener("beforeprint", () => {
-  savedScale = scale;
-  scale = 1;
-
-  applyScale(0, 0);
-
-  scrollLayer.scrollLeft = 0;
-  scrollLayer.scrollTop  = 0;
-});
-
-window.addEventListener("afterprint", () => {
-  scale = savedScale;
-
-  applyScale(0, 0);
-
-  scrollLayer.scrollLeft = 0;
-  scrollLayer.scrollTop  = 0;
-});
-
-scrollLayer.addEventListener("touchstart", e => {
-  if (e.touches.length === 2) {
-    startDist = getDistance(e.touches[0], e.touches[1]);
-    startScale = scale;
-    pinchCenter = getCenter(e.touches[0], e.touches[1]);
-  }
-}, { passive: false });
-
-
-scrollLayer.addEventListener("touchmove", e => {
-  if (e.touches.length === 2) {
-    e.preventDefault();   // ← ブラウザのズームだけ止める
-    e.stopPropagation(); // ← 追加（暴走防止）
-
-    const newDist = getDistance(e.touches[0], e.touches[1]);
-    const ratio = newDist / startDist;
-    const minScale = getMinScale();
-
-    // ★ 毎回「今の指の中点」を使う
-    const center = getCenter(e.touches[0], e.touches[1]);
-
-    scale = Math.min(3, Math.max(minScale, startScale * ratio));
-    applyScale(center.x, center.y);
-
-
-  }
-}, { passive: false });
-
-scrollLayer.addEventListener("touchend", e => {
-  if (e.touches.length < 2) {
-    startDist = null;
-  }
-}, { passive: false });
-
-scrollLayer.addEventListener("touchcancel", () => {
-  startDist = null;
-}, { passive: false });
-
-
-
-// 初期状態：画面にちょうどフィット
-scale = getFitScale();
-applyScale(scrollLayer.clientWidth / 2, scrollLayer.clientHeight / 2);
-
-// 左上から表示（変な位置防止）
-scrollLayer.scrollLeft = 0;
-scrollLayer.scrollTop  = 0;
-
-function getFitScale(){
-  const vw = scrollLayer.clientWidth;
-  const vh = scrollLayer.clientHeight;
-
-  const rect = contentLayer.getBoundingClientRect();
-  const sx = vw / rect.width;
-  const sy = vh / rect.height;
-
-  return Math.min(sx, sy);
-}
-
-
-</script>
-
-
-
-
-
-</body>
-</html>
-"""
-
-
-ADMIN_HTML = """
-<!doctype html>
-<html lang="ja">
-<head>
-<meta charset="utf-8">
-<title>管理者</title>
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<style>
-body{
-  font-family: sans-serif;
-  padding: 16px;
-  background: #f5f5f5;
-}
-
-h2{
-  font-size: 24px;
-  margin-bottom: 12px;
-}
-
-.controls{
-  margin-bottom: 12px;
-}
-
-.controls button{
-  padding: 8px 12px;
-  font-size: 15px;
-  margin-right: 6px;
+.controls button{
+  padding: 8px 12px;
+  font-size: 15px;
+  margin-right: 6px;
 }
 
 /* テーブル全体を包んで横スクロール対応 */
@@ -1151,6 +1220,17 @@ th{
   margin-top: 16px;
 }
 
+.flash{
+  padding: 8px 12px;
+  margin-bottom: 12px;
+  background: #e8f5e9;
+  border-radius: 6px;
+}
+
+.flash.error{
+  background: #fdecea;
+}
+
 @media (max-width: 600px){
   h2{ font-size: 22px; }
   th, td{ font-size: 15px; padding: 8px; }
@@ -1198,6 +1278,15 @@ th{
 
 </form>
 
+<h2>単語帳の差し替え</h2>
+{% for category, message in get_flashed_messages(with_categories=true) %}
+<p class="flash {{category}}">{{message}}</p>
+{% endfor %}
+<form method="post" action="/admin/wordbank" enctype="multipart/form-data" class="controls">
+  <input type="file" name="file" accept=".xlsx" required>
+  <button>アップロード</button>
+</form>
+
 <div class="footer">
   <a href="/logout">ログアウト</a>
 </div>
@@ -1262,13 +1351,121 @@ button{
     管理者による承認後にログインできます。
   </p>
 
-  <form action="/login">
-    <button type="submit">ログイン画面に戻る</button>
-  </form>
-</div>
-</body>
-</html>
-"""
+  <form action="/login">
+    <button type="submit">ログイン画面に戻る</button>
+  </form>
+</div>
+</body>
+</html>
+"""
+
+
+# -------------------------
+# テンプレート登録
+# -------------------------
+# 上の文字列は render_template_string だと毎回コンパイルされるので、
+# 起動時に一度だけ登録して、コンパイル済みのものを使い回す
+INLINE_TEMPLATES = {
+    "app/login.html": LOGIN_HTML,
+    "app/register.html": REGISTER_HTML,
+    "app/index.html": INDEX_HTML,
+    "app/html_test.html": HTML_TEST_TEMPLATE,
+    "app/admin.html": ADMIN_HTML,
+    "app/pending.html": PENDING_HTML,
+}
+
+# コンパイルは import 時に1回だけ。gunicorn（preload_app）のワーカーは
+# fork でコンパイル済みのテンプレートを引き継ぐ
+app.jinja_loader = ChoiceLoader([
+    DictLoader(INLINE_TEMPLATES),
+    FileSystemLoader(os.path.join(app.root_path, app.template_folder)),
+])
+
+for _name in INLINE_TEMPLATES:
+    app.jinja_env.get_template(_name)
+
+
+# -------------------------
+# 静的ファイル（指紋つき・圧縮済み）
+# -------------------------
+# HTMLテストの CSS/JS は中身のハッシュを名前に入れて配信し、
+# ブラウザには1年間 immutable でキャッシュさせる。
+# gzip / brotli はビルド時（flask build-assets）に static/dist へ作っておく。
+# 無ければ起動時にメモリ上で作る
+ASSET_FILES = ["html_test.css", "html_test.js"]
+ASSET_DIST = Path(app.static_folder) / "dist"
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def _fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _compress_all(data):
+    out = {"gzip": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        out["br"] = brotli.compress(data, quality=11)
+    return out
+
+
+def build_assets(out_dir=ASSET_DIST):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    written = []
+    for name in ASSET_FILES:
+        data = (Path(app.static_folder) / name).read_bytes()
+        fp = _fingerprint(name, data)
+        (out_dir / fp).write_bytes(data)
+        written.append(fp)
+        for enc, body in _compress_all(data).items():
+            (out_dir / (fp + ASSET_SUFFIXES[enc])).write_bytes(body)
+            written.append(fp + ASSET_SUFFIXES[enc])
+    return written
+
+
+def load_assets():
+    assets = {}
+    urls = {}
+    for name in ASSET_FILES:
+        data = (Path(app.static_folder) / name).read_bytes()
+        fp = _fingerprint(name, data)
+        variants = {}
+        for enc, suffix in ASSET_SUFFIXES.items():
+            p = ASSET_DIST / (fp + suffix)
+            if p.exists():
+                variants[enc] = p.read_bytes()
+        if "gzip" not in variants or ("br" not in variants and brotli is not None):
+            variants = {**_compress_all(data), **variants}
+        mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        assets[fp] = (mimetype, data, variants)
+        urls[name] = f"/assets/{fp}"
+    return assets, urls
+
+
+ASSETS, ASSET_URLS = load_assets()
+
+
+@app.template_global()
+def asset_url(name):
+    return ASSET_URLS[name]
+
+
+def negotiate_encoding(available):
+    # Accept-Encoding の q 値に従って br / gzip を選ぶ（どちらも不可なら None）
+    offered = [enc for enc in ("br", "gzip") if enc in available]
+    if not offered:
+        return None
+    return request.accept_encodings.best_match(offered)
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """HTMLテスト用の CSS/JS を指紋つきで static/dist に書き出し、gzip/brotli で圧縮しておく。"""
+    for name in build_assets():
+        click.echo(f"wrote {ASSET_DIST / name}")
+    if brotli is None:
+        click.echo("⚠ brotli が無いので gzip だけ作りました")
 
 
 
@@ -1277,9 +1474,18 @@ button{
 # ログイン制御
 # -------------------------
 
+@app.before_request
+def check_schema():
+    # DBに触れるページだけで確かめる（PDF生成などは DB 不要）
+    if request.path.startswith(("/login", "/register", "/admin", "/approve",
+                                "/reset", "/delete", "/bulk_action")):
+        ensure_schema()
+
+
 @app.before_request
 def require_login():
-    if request.path.startswith(("/login", "/register", "/static", "/favicon.ico")):
+    if request.path.startswith(("/login", "/register", "/static", "/assets", "/favicon.ico",
+                                "/metrics")):
         return
     if not session.get("user_id"):
         return redirect("/login")
@@ -1298,14 +1504,9 @@ def login():
         u = request.form["username"]
         p = request.form["password"]
 
-        with get_db() as cur:
-            cur.execute(
-                "SELECT id, username, password_hash, role, approved FROM users WHERE username=%s",
-                (u,)
-            )
-            user = cur.fetchone()
+        user = find_user(u)
 
-        if not user or not check_password_hash(user[2], p):
+        if not user or not verify_password(user[2], p):
             error = "ID または パスワードが違います"
         elif not user[4]:
             return redirect("/pending")
@@ -1315,7 +1516,7 @@ def login():
             session["role"] = user[3]
             return redirect("/admin" if user[3] == "admin" else "/")
 
-    return render_template_string(LOGIN_HTML, error=error)
+    return render_template("app/login.html", error=error)
 
 
 
@@ -1323,6 +1524,8 @@ def login():
 @app.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
+        username = request.form["username"]
+        pwhash = hash_password(request.form["password"])
         try:
             with get_db() as cur:
                 cur.execute(
@@ -1331,8 +1534,8 @@ def register():
                     VALUES (%s, %s, %s, %s)
                     """,
                     (
-                        request.form["username"],
-                        generate_password_hash(request.form["password"]),
+                        username,
+                        pwhash,
                         "student",
                         False
                     )
@@ -1343,21 +1546,60 @@ def register():
             <a href="/register">戻る</a>
             """
 
+        invalidate_user_cache(username)
         return """
         登録しました。承認待ちです。<br>
         <a href='/login'>ログイン画面へ</a>
         """
 
-    return render_template_string(REGISTER_HTML)
+    return render_template("app/register.html")
 
 
 
 
+# トップページはシート名だけで決まるので、単語帳のバージョンごとに1回だけ描く
+_index_page = {}
+
+
 @app.route("/")
 def index():
-    wb = load_workbook(EXCEL_PATH, data_only=True)
-    sheets = wb.sheetnames
-    return render_template_string(INDEX_HTML, sheets=sheets)
+    bank = get_wordbank(EXCEL_PATH)
+    page = _index_page.get(bank.version)
+    if page is None:
+        with timed("render"):
+            body = render_template("app/index.html", sheets=bank.sheetnames)
+        # テンプレートを変えたデプロイでも ETag が変わるように両方から作る
+        etag = hashlib.sha256(
+            (bank.version + INDEX_HTML).encode("utf-8")
+        ).hexdigest()[:32]
+        page = (etag, body)
+        _index_page.clear()
+        _index_page[bank.version] = page
+
+    etag, body = page
+    g.cache_key = ("index", etag)
+    res = app.response_class(body, mimetype="text/html")
+    res.set_etag(etag, weak=True)
+    # ログインが必要なページなので共有キャッシュには置かせず、毎回確かめさせる
+    res.headers["Cache-Control"] = "private, no-cache"
+    return res.make_conditional(request)
+
+
+@app.route("/assets/<name>")
+def asset(name):
+    entry = ASSETS.get(name)
+    if entry is None:
+        abort(404)
+
+    mimetype, data, variants = entry
+    enc = negotiate_encoding(variants)
+    res = app.response_class(variants[enc] if enc else data, mimetype=mimetype)
+    if enc:
+        res.headers["Content-Encoding"] = enc
+    res.vary.add("Accept-Encoding")
+    res.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    res.set_etag(f"{name}-{enc or 'identity'}")
+    return res.make_conditional(request)
 
 
 @app.route("/admin")
@@ -1371,42 +1613,123 @@ def admin():
         )
         users = cur.fetchall()
 
-    return render_template_string(ADMIN_HTML, users=users)
+    return render_template("app/admin.html", users=users)
 
 
 
 @app.route("/approve/<int:uid>")
 def approve(uid):
-    conn, cur = get_db()
-    cur.execute("UPDATE users SET approved=true WHERE id=%s", (uid,))
-    conn.commit()
-    conn.close()
+    if session.get("role") != "admin":
+        return redirect("/")
+
+    with get_db() as cur:
+        cur.execute("UPDATE users SET approved=true WHERE id=%s", (uid,))
+    invalidate_user_cache()
     return redirect("/admin")
 
 
 @app.route("/reset/<int:uid>")
 def reset(uid):
-    conn, cur = get_db()
-    cur.execute(
-        "UPDATE users SET password_hash=%s WHERE id=%s",
-        (generate_password_hash("1234"), uid)
-    )
-    conn.commit()
-    conn.close()
+    if session.get("role") != "admin":
+        return redirect("/")
+
+    with get_db() as cur:
+        cur.execute(
+            "UPDATE users SET password_hash=%s WHERE id=%s",
+            (hash_password("1234"), uid)
+        )
+    invalidate_user_cache()
     return redirect("/admin")
 
 
 @app.route("/delete/<int:uid>")
 def delete(uid):
-    conn, cur = get_db()
-    cur.execute("DELETE FROM users WHERE id=%s", (uid,))
-    conn.commit()
-    conn.close()
+    if session.get("role") != "admin":
+        return redirect("/")
+
+    with get_db() as cur:
+        cur.execute("DELETE FROM users WHERE id=%s", (uid,))
+    invalidate_user_cache()
     return redirect("/admin")
-  
+
+@app.route("/admin/stats")
+def admin_stats():
+    if session.get("role") != "admin":
+        return redirect("/")
+    return stats_snapshot()
+
+
+def _sheet_list(names, limit=5):
+    # flash はセッション Cookie に入るので、シート名は数件だけにする
+    text = "、".join(names[:limit])
+    if len(names) > limit:
+        text += f" ほか{len(names) - limit}件"
+    return text
+
+
+def _wordbank_summary(result):
+    if not result["published"]:
+        return "内容が今の単語帳と同じなので、差し替えませんでした"
+    parts = []
+    for key, label in (("added", "追加"), ("changed", "変更"), ("removed", "削除")):
+        names = result[key]
+        parts.append(f"{label} {len(names)}" + (f"（{_sheet_list(names)}）" if names else ""))
+    parts.append(f"変更なし {len(result['unchanged'])}")
+    return "単語帳を差し替えました：" + "・".join(parts)
+
+
+@app.route("/admin/wordbank", methods=["POST"])
+def upload_wordbank():
+    if session.get("role") != "admin":
+        return redirect("/")
+    # 画面のフォームからは /admin に戻して結果を出す。JSON を求められたときだけ JSON で返す
+    wants_json = request.accept_mimetypes.best_match(
+        ["text/html", "application/json"]) == "application/json"
+
+    def failed(message, status=400):
+        if wants_json:
+            return {"error": message}, status
+        flash(message, "error")
+        return redirect("/admin")
+
+    try:
+        f = request.files.get("file")
+    except RequestEntityTooLarge:
+        return failed("ファイルが大きすぎます", 413)
+    if f is None or not f.filename:
+        return failed("ファイルを選んでください")
+
+    # 同じディレクトリに置いておけば、そのまま os.replace で差し替えられる
+    tmp = EXCEL_PATH.resolve().parent / f".upload-{uuid.uuid4().hex}.xlsx"
+    f.save(tmp)
+    try:
+        result = publish_wordbank(tmp)
+    except WordbankInvalid as e:
+        return failed(str(e))
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    if wants_json:
+        return result
+    flash(_wordbank_summary(result), "ok")
+    return redirect("/admin")
+
+
+@app.route("/metrics")
+def metrics():
+    # 管理者のセッションか、METRICS_TOKEN を持つスクレイパーだけ
+    auth = request.headers.get("Authorization", "")
+    if session.get("role") != "admin" and not (
+            METRICS_TOKEN and hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}")):
+        abort(403)
+    return app.response_class(
+        render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.route("/pending")
 def pending():
-    return render_template_string(PENDING_HTML)
+    return render_template("app/pending.html")
 
 
 
@@ -1421,22 +1744,24 @@ def bulk_action():
         return redirect("/")
 
     action = request.form.get("action")
-    uids = request.form.getlist("uids")
+    uids = [int(uid) for uid in request.form.getlist("uids") if uid.isdigit()]
 
     if not uids:
         return redirect("/admin")
 
+    # 人数に関係なく1文で済ませる
     with get_db() as cur:
         if action == "approve":
-            cur.executemany(
-                "UPDATE users SET approved=true WHERE id=%s",
-                [(uid,) for uid in uids]
+            cur.execute(
+                "UPDATE users SET approved=true WHERE id = ANY(%s)",
+                (uids,)
             )
         elif action == "delete":
-            cur.executemany(
-                "DELETE FROM users WHERE id=%s",
-                [(uid,) for uid in uids]
+            cur.execute(
+                "DELETE FROM users WHERE id = ANY(%s)",
+                (uids,)
             )
+    invalidate_user_cache()
 
     return redirect("/admin")
 
@@ -1447,17 +1772,21 @@ def generate_html_test():
     sheet = data["sheet"]
     start = int(data["start"])
     end   = int(data["end"])
-
-    rows = load_sheet_rows(EXCEL_PATH, sheet)
-    items = pick40(rows, start, end)
-
-    return render_template_string(
-        HTML_TEST_TEMPLATE,
-        items=items,
-        sheet=sheet,
-        start=start,
-        end=end
-    )
+    seed  = parse_seed(data)
+
+    rows = load_sheet_range(EXCEL_PATH, sheet, start, end)
+    g.sheet = sheet
+    with timed("sample"):
+        items = pick40(rows, start, end, seed)
+
+    with timed("render"):
+        return render_template(
+            "app/html_test.html",
+            items=items,
+            sheet=sheet,
+            start=start,
+            end=end
+        )
 
 
   
@@ -1467,21 +1796,185 @@ def generate():
     sheet = data["sheet"]
     start = int(data["start"])
     end   = int(data["end"])
+    seed  = parse_seed(data)
+
+    # seed がなければここで決める。作ったPDFはその seed で覚えておき、
+    # 画面の「同じ並びでもう一度印刷」（X-Test-Seed を送り返す）はキャッシュから返す
+    fresh = seed is None
+    if fresh:
+        seed = random.getrandbits(32)
+    bank = get_wordbank(EXCEL_PATH)
+    key = (bank.version, sheet, start, end, seed)
+    pdf = None if fresh else pdf_cache.get(key)
+
+    if pdf is None:
+        rows = load_sheet_range(EXCEL_PATH, sheet, start, end)
+        with timed("sample"):
+            items = pick40(rows, start, end, seed)
+
+        with timed("render"):
+            pdf = render_pdf(make_two_page_pdf, items, sheet, start, end)
+        pdf_cache.put(key, pdf)
+        stat_add("pdf_rendered_total")
+    else:
+        stat_add("pdf_cache_hits_total")
 
-    rows = load_sheet_rows(EXCEL_PATH, sheet)
-    items = pick40(rows, start, end)
+    g.sheet = sheet
+    return pdf_response(pdf, seed, key)
 
-    pdf_path = make_two_page_pdf(items, sheet, start, end)
 
-    return send_file(
-        str(pdf_path),
-        mimetype="application/pdf",
-        as_attachment=False
-    )
+@app.route("/generate_batch", methods=["POST"])
+def generate_batch():
+    data = request.get_json()
+    sheet = data["sheet"]
+    start = int(data["start"])
+    end   = int(data["end"])
+    seed  = parse_seed(data)
+    copies = int(data.get("copies", 1))
+    if not 1 <= copies <= MAX_BATCH_COPIES:
+        return f"部数は1〜{MAX_BATCH_COPIES}で指定してください", 400
+
+    fresh = seed is None
+    if fresh:
+        seed = random.getrandbits(32)
+    bank = get_wordbank(EXCEL_PATH)
+    key = (bank.version, sheet, start, end, seed, copies)
+    pdf = None if fresh else pdf_cache.get(key)
+
+    if pdf is None:
+        rows = load_sheet_range(EXCEL_PATH, sheet, start, end)
+        with timed("sample"):
+            item_sets = pick_batch(rows, start, end, copies, seed)
+
+        with timed("render"):
+            pdf = render_pdf(make_batch_pdf, item_sets, sheet, start, end)
+        pdf_cache.put(key, pdf)
+        stat_add("pdf_rendered_total")
+    else:
+        stat_add("pdf_cache_hits_total")
 
-def load_sheet_rows(path, sheet):
-    wb = load_workbook(str(path), data_only=True)
-    ws = wb[sheet]
+    g.sheet = sheet
+    return pdf_response(pdf, seed, key)
+
+
+def pdf_response(pdf, seed, cache_key):
+    stat_add("pdf_responses_total")
+    stat_add("pdf_bytes_served_total", len(pdf))
+    # send_file だと後段で圧縮できないので、バイト列のまま返す
+    res = app.response_class(pdf, mimetype="application/pdf")
+    # 同じ並びを刷り直すときはこの seed を送る
+    res.headers["X-Test-Seed"] = str(seed)
+    g.cache_key = ("pdf",) + cache_key
+    return res
+
+
+def parse_seed(data):
+    seed = data.get("seed")
+    if seed is None or seed == "":
+        return None
+    return int(seed)
+
+# ===== 単語帳キャッシュ（ワーカーごとに1回だけ読む） =====
+class WordBank:
+    def __init__(self, stamp, version, sheetnames, sheets, generation=0):
+        self.stamp = stamp            # (mtime_ns, size) 変わったら読み直す
+        self.version = version        # 元 Excel の sha256
+        self.sheetnames = sheetnames
+        self.sheets = sheets          # シート名 -> WordSheet
+        self.generation = generation  # このプロセスで何回目に読んだものか
+
+
+class WordSheet:
+    # 番号つきの行だけを番号順に、列ごとに持つ（1行ごとの dict は作らない）。
+    #   nums      : array('q')  番号（範囲は二分探索で引く）
+    #   questions : 問題のタプル、answers : 解答のタプル（同じ文字列は intern して1つにする）
+    # 行は読み取り専用の Word で渡すので、キャッシュが書き換えられることはない
+    def __init__(self, rows, digest=None):
+        # rows: (num, q, a) の並び。同じ番号は元の順のまま
+        numbered = sorted((r for r in rows if r[0] is not None), key=lambda r: r[0])
+        self.nums = array("q", [r[0] for r in numbered])
+        self.questions = tuple(sys.intern(r[1]) for r in numbered)
+        self.answers = tuple(sys.intern(r[2]) for r in numbered)
+        self.digest = digest    # シートの中身の sha256（同じなら読み直しで使い回す）
+
+    def __len__(self):
+        return len(self.nums)
+
+    def __getitem__(self, i):
+        return Word(self.nums[i], self.questions[i], self.answers[i])
+
+    def span(self, start, end):
+        # start <= num <= end の行の位置 [lo, hi)
+        return bisect_left(self.nums, start), bisect_right(self.nums, end)
+
+
+class Word(tuple):
+    # 1問分 (num, q, a, no) の読み取り専用の行。
+    # テンプレートは item.no / item.q、PDF は r['q'] で読むので両方に応える。
+    # tuple なのでそのまま pickle でき、PDF のプロセスプールに渡せる
+    __slots__ = ()
+    _index = {"num": 0, "q": 1, "a": 2, "no": 3}
+
+    def __new__(cls, num, q, a, no=None):
+        return tuple.__new__(cls, (num, q, a, no))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    num = property(lambda self: tuple.__getitem__(self, 0))
+    q = property(lambda self: tuple.__getitem__(self, 1))
+    a = property(lambda self: tuple.__getitem__(self, 2))
+    no = property(lambda self: tuple.__getitem__(self, 3))
+
+
+_wordbanks = {}
+_wordbank_lock = threading.Lock()
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def open_workbook(path):
+    # 読み取り専用モード：シートの XML を必要になったときに1行ずつ読むので、
+    # ブック全体のセルを作らない（メモリは1シート分の行だけ）
+    wb = load_workbook(str(path), read_only=True, data_only=True)
+    try:
+        yield wb
+    finally:
+        wb.close()
+
+
+def read_sheet_rows(path, sheet):
+    # 1シートだけを読む（他のシートの XML は開かない）
+    with open_workbook(path) as wb:
+        return _parse_rows(wb[sheet])
+
+
+def _parse_rows(ws):
+    # 読み取り専用のシートはファイルに書かれた dimension（使われている範囲）の
+    # 最終行で止まってしまう。古い値のままのファイルもあるので当てにせず、
+    # sheetData の終わりまで読む
+    if hasattr(ws, "reset_dimensions"):
+        ws.reset_dimensions()
     rows = []
     for row in ws.iter_rows(min_row=2, max_col=3, values_only=True):
         a, b, c = row
@@ -1497,66 +1990,687 @@ def load_sheet_rows(path, sheet):
             "a": "" if c is None else str(c)
         })
     return rows
-  
 
 
-def pick40(rows, start, end):
-    r = [x for x in rows if x["num"] is not None and start <= x["num"] <= end]
-    random.shuffle(r)
-    r = r[:40]
-    while len(r) < 40:
-        r.append({"num": None, "q": "", "a": ""})
-    for i, rr in enumerate(r):
-        rr["no"] = i + 1
-    return r
+# ===== 単語帳バイナリ =====
+# [MAGIC][ヘッダ長 u32][ヘッダ JSON][シートごとに nums / offsets / blob]
+#   nums    : array('q')  番号（番号なしは NUM_NONE）
+#   offsets : array('I')  blob 内の位置 q0, a0, q1, a1, ... 終端
+#   blob    : UTF-8 文字列を連結したもの
+WORDBANK_MAGIC = b"WORDBNK1"
+NUM_NONE = -(1 << 63)
 
-def wrap_text(text, font, size, max_width):
+
+def compiled_path(path):
+    return WORDBANK_DIR / f"{Path(path).stem}.wordbank"
+
+
+def _read_header(f):
+    if f.read(len(WORDBANK_MAGIC)) != WORDBANK_MAGIC:
+        return None
+    (n,) = struct.unpack("<I", f.read(4))
+    return json.loads(f.read(n).decode("utf-8"))
+
+
+def _compiled_version(dst):
+    try:
+        with open(dst, "rb") as f:
+            header = _read_header(f)
+    except (OSError, ValueError, struct.error):
+        return None
+    if not header or header.get("byteorder") != sys.byteorder:
+        return None
+    return header.get("source_sha256")
+
+
+@contextmanager
+def wordbank_file_lock(dst):
+    # コンパイル済みの単語帳を書き換えるワーカー・プロセス同士のロック。
+    # dst 自体は os.replace で入れ替わる（inode が変わる）ので、横に置いた .lock で取る
+    if fcntl is None:
+        yield
+        return
+    lock = Path(dst).with_name(f"{Path(dst).name}.lock")
+    lock.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _encode_sheet(rows):
+    # 1シート分のバイト列 (nums, offsets, blob) と、その sha256
+    nums = array("q", [NUM_NONE if r["num"] is None else r["num"] for r in rows])
+    blob = bytearray()
+    offsets = array("I", [0])
+    for r in rows:
+        for text in (r["q"], r["a"]):
+            blob += text.encode("utf-8")
+            offsets.append(len(blob))
+    section = (nums.tobytes(), offsets.tobytes(), bytes(blob))
+    digest = hashlib.sha256()
+    for part in section:
+        digest.update(part)
+    return section, digest.hexdigest()
+
+
+# Excel を単語帳バイナリにコンパイルする。内容が同じなら何もしない
+def build_wordbank(src=EXCEL_PATH, dst=None, force=False):
+    dst = Path(dst or compiled_path(src))
+    # 差し替え（publish_wordbank）の途中で古い Excel から作り直さないよう、確認から書き込みまでロックする
+    with wordbank_file_lock(dst):
+        version = _file_sha256(src)
+        if not force and _compiled_version(dst) == version:
+            return False
+        write_compiled_wordbank(src, dst, version)
+    return True
+
+
+def write_compiled_wordbank(src, dst, version):
+    sections = []
+    header = {
+        "source_sha256": version,
+        "byteorder": sys.byteorder,
+        "sheetnames": [],
+        "sheets": [],
+    }
+    # シートを1枚ずつ読んでバイト列にする（行の dict は次のシートまでに捨てる）
+    with open_workbook(src) as wb:
+        header["sheetnames"] = list(wb.sheetnames)
+        for ws in wb.worksheets:
+            rows = _parse_rows(ws)
+            section, digest = _encode_sheet(rows)
+            header["sheets"].append({
+                "name": ws.title,
+                "count": len(rows),
+                "numbered": sum(1 for r in rows if r["num"] is not None),
+                "sha256": digest,
+            })
+            sections.append(section)
+
+    # セクション位置はヘッダの長さに依存するので、ヘッダ以外の位置を相対で持つ
+    pos = 0
+    for info, (nums_b, offs_b, blob_b) in zip(header["sheets"], sections):
+        info["nums"] = pos
+        pos += len(nums_b)
+        info["offsets"] = pos
+        pos += len(offs_b)
+        info["blob"] = pos
+        info["blob_len"] = len(blob_b)
+        pos += len(blob_b)
+        pos += -pos % 8    # array を揃えて置く
+
+    head = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    head += b" " * (-(len(WORDBANK_MAGIC) + 4 + len(head)) % 8)
+
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(WORDBANK_MAGIC)
+        f.write(struct.pack("<I", len(head)))
+        f.write(head)
+        for nums_b, offs_b, blob_b in sections:
+            f.write(nums_b)
+            f.write(offs_b)
+            f.write(blob_b)
+            f.write(b"\0" * (-f.tell() % 8))
+    os.replace(tmp, dst)    # 他のワーカーが読みかけでも壊れない
+
+
+def load_compiled_wordbank(dst, reuse=None):
+    # reuse: {シート名: sha256}。中身が同じシートは読まずに飛ばす（sheets に入らない）
+    reuse = reuse or {}
+    with open(dst, "rb") as f:
+        header = _read_header(f)
+        base = f.tell()
+        digests = {info["name"]: info.get("sha256") for info in header["sheets"]}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            sheets = {}
+            for info in header["sheets"]:
+                if info.get("sha256") and reuse.get(info["name"]) == info["sha256"]:
+                    continue
+                n = info["count"]
+                nums = array("q")
+                nums.frombytes(mm[base + info["nums"]:base + info["nums"] + 8 * n])
+                offsets = array("I")
+                offsets.frombytes(mm[base + info["offsets"]:base + info["offsets"] + 4 * (2 * n + 1)])
+                blob = mm[base + info["blob"]:base + info["blob"] + info["blob_len"]]
+                rows = []
+                for i in range(n):
+                    num = nums[i]
+                    rows.append((
+                        None if num == NUM_NONE else num,
+                        blob[offsets[2 * i]:offsets[2 * i + 1]].decode("utf-8"),
+                        blob[offsets[2 * i + 1]:offsets[2 * i + 2]].decode("utf-8"),
+                    ))
+                sheets[info["name"]] = rows
+    return header["source_sha256"], header["sheetnames"], sheets, digests
+
+
+def get_wordbank(path=EXCEL_PATH):
+    with timed("wordbank"):
+        if WORDBANK_BACKEND == "postgres":
+            return _get_db_wordbank()
+        return _get_wordbank(path)
+
+
+def _get_wordbank(path):
+    key = str(path)
+    bank = _wordbanks.get(key)
+    # 監視スレッドが動いていれば変更はそちらが反映するので、ここでは stat しない
+    if bank is not None and _watchers.get(key) == os.getpid():
+        return bank
+
+    if bank is None or bank.stamp != _file_stamp(path):
+        bank = reload_wordbank(path)
+    # 監視スレッドはリクエストを受けるプロセス（fork 後のワーカー）でだけ起こす
+    if WORDBANK_WATCH != "off" and has_request_context():
+        _start_watcher(path)
+    return bank
+
+
+def reload_wordbank(path=EXCEL_PATH):
+    # 作り終えてから辞書の1項目を差し替えるので、読む側が途中の状態を見ることはない
+    key = str(path)
+    with _wordbank_lock:
+        stamp = _file_stamp(path)
+        # 他スレッドが読み終えていればそれを使う
+        bank = _wordbanks.get(key)
+        if bank is not None and bank.stamp == stamp:
+            return bank
+
+        global _wordbank_generation
+        t0 = time.perf_counter()
+        # 内容が変わっていなければコンパイル済みをそのまま使う
+        build_wordbank(path)
+        # 中身が同じシートは今の WordSheet をそのまま使い、変わったシートだけ作る
+        reuse = {}
+        if bank is not None:
+            reuse = {name: ws.digest for name, ws in bank.sheets.items() if ws.digest}
+        version, sheetnames, loaded, digests = load_compiled_wordbank(compiled_path(path), reuse)
+        sheets = {}
+        for name in digests:
+            if name in loaded:
+                sheets[name] = WordSheet(loaded[name], digests[name])
+            else:
+                sheets[name] = bank.sheets[name]
+        stat_add("wordbank_sheets_reused_total", len(sheets) - len(loaded))
+        _wordbank_generation += 1
+        bank = WordBank(stamp, version, sheetnames, sheets, _wordbank_generation)
+        _wordbanks[key] = bank
+
+        elapsed = time.perf_counter() - t0
+        stat_add("wordbank_reloads_total")
+        gauge_set("wordbank_generation", bank.generation)
+        gauge_set("wordbank_last_reload_seconds", round(elapsed, 6))
+        observe("wordtest_wordbank_reload_seconds", elapsed)
+    return bank
+
+
+# ===== 単語帳の監視（Excel が変わったら裏で読み直す） =====
+# ワーカーごとに監視スレッドを1本立て、変更を見つけたらリクエストとは別に
+# 読み直して差し替える。Linux では inotify で置き場所のディレクトリを見て、
+# それ以外は WORDBANK_POLL_INTERVAL 秒ごとに stat する
+#   WORDBANK_WATCH = auto（inotify があれば使う）/ poll / off（リクエストごとに stat）
+WORDBANK_WATCH = os.environ.get("WORDBANK_WATCH", "auto")
+WORDBANK_POLL_INTERVAL = float(os.environ.get("WORDBANK_POLL_INTERVAL", 2))
+# 変更を見つけてから読み直すまで待つ秒数（書き込みが続くあいだはまとめる）
+WORDBANK_SETTLE = float(os.environ.get("WORDBANK_SETTLE", 0.3))
+
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+_wordbank_generation = 0
+_watchers = {}    # パス -> 監視スレッドを起こしたプロセスの pid
+_watchers_lock = threading.Lock()
+
+
+def _start_watcher(path):
+    key = str(path)
+    if _watchers.get(key) == os.getpid():
+        return
+    with _watchers_lock:
+        if _watchers.get(key) == os.getpid():
+            return
+        wait = _inotify_waiter(path) if WORDBANK_WATCH == "auto" else None
+        gauge_set("wordbank_watch_inotify", int(wait is not None))
+        if wait is None:
+            wait = lambda: time.sleep(WORDBANK_POLL_INTERVAL)
+        threading.Thread(
+            target=_watch_wordbank, args=(path, wait),
+            name="wordbank-watcher", daemon=True,
+        ).start()
+        _watchers[key] = os.getpid()
+
+
+def _inotify_waiter(path):
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        # Excel は os.replace で差し替わる（inode が変わる）ことがあるので、ディレクトリを見る
+        folder = os.fsencode(Path(path).resolve().parent)
+        mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, folder, mask) < 0:
+            os.close(fd)
+            return None
+    except (OSError, AttributeError):
+        return None
+
+    def wait():
+        # 通知がなくても WORDBANK_POLL_INTERVAL ごとに1回は確かめる（取りこぼし対策）
+        ready, _, _ = select.select([fd], [], [], WORDBANK_POLL_INTERVAL)
+        if ready:
+            time.sleep(WORDBANK_SETTLE)
+            try:
+                while os.read(fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    return wait
+
+
+def _watch_wordbank(path, wait):
+    key = str(path)
+    failed = None
+    while True:
+        wait()
+        flush_metrics()    # 暇なワーカーの /metrics の値も古くならないように
+        try:
+            stamp = _file_stamp(path)
+        except OSError:
+            continue    # 差し替えの途中など
+        bank = _wordbanks.get(key)
+        # 読めなかったファイルは、次に書き換わるまで読み直さない
+        if (bank is not None and bank.stamp == stamp) or stamp == failed:
+            continue
+        try:
+            reload_wordbank(path)
+            failed = None
+        except Exception as e:
+            failed = stamp
+            stat_add("wordbank_reload_errors_total")
+            print(f"⚠ 単語帳の読み直しに失敗（前の版のまま）: {e!r}")
+
+
+# ===== 単語帳の差し替え（管理画面からのアップロード） =====
+# 先にコンパイル済みの単語帳を作って置き換え、そのあと Excel を os.replace する。
+# 他のワーカーは監視スレッドで気づき、コンパイル済みの版が一致するので
+# Excel を読み直さずに、変わったシートだけを作り直して差し替える。
+# （Render などではディスクが消えるので、残すには Excel をリポジトリにも入れること）
+class WordbankInvalid(Exception):
+    pass
+
+
+_publish_lock = threading.Lock()
+
+
+def publish_wordbank(src):
+    # src はアップロードを保存した一時ファイル（EXCEL_PATH と同じディレクトリに置く）
+    global _db_wordbank
+    with open(src, "rb") as f:
+        if f.read(4) != b"PK\x03\x04":
+            raise WordbankInvalid("xlsx ファイルではありません")
+
+    t0 = time.perf_counter()
+    dst = compiled_path(EXCEL_PATH)
+    staging = dst.with_name(f"{dst.name}.{os.getpid()}.{uuid.uuid4().hex}.staging")
+    with _publish_lock:
+        try:
+            try:
+                write_compiled_wordbank(src, staging, _file_sha256(src))
+            except Exception as e:
+                raise WordbankInvalid(f"Excel として読めません: {e}")
+            with open(staging, "rb") as f:
+                header = _read_header(f)
+            if not any(info["numbered"] for info in header["sheets"]):
+                raise WordbankInvalid("番号のついた行がありません（A列に番号、B列に問題、C列に解答）")
+
+            if WORDBANK_BACKEND == "postgres":
+                old = db_sheet_digests()
+                current = get_wordbank().version
+            else:
+                bank = get_wordbank(EXCEL_PATH)
+                old = {name: ws.digest for name, ws in bank.sheets.items()}
+                current = bank.version
+            new = {info["name"]: info["sha256"] for info in header["sheets"]}
+            diff = {
+                "added": [n for n in new if n not in old],
+                "removed": [n for n in old if n not in new],
+                "changed": [n for n in new if n in old and old[n] != new[n]],
+                "unchanged": [n for n in new if n in old and old[n] == new[n]],
+            }
+            if header["source_sha256"] == current:
+                return {"version": current, "published": False, **diff}
+
+            # 他のプロセスの build_wordbank は、2つの置き換えが終わるまで待たせる
+            # （間に入ると古い Excel から作り直して上書きしてしまう）
+            with wordbank_file_lock(dst):
+                os.replace(staging, dst)
+                os.replace(src, EXCEL_PATH)
+        finally:
+            staging.unlink(missing_ok=True)
+
+        if WORDBANK_BACKEND == "postgres":
+            import_wordbank(EXCEL_PATH)
+            _db_wordbank = None
+            generation = None
+        else:
+            generation = reload_wordbank(EXCEL_PATH).generation
+
+    stat_add("wordbank_uploads_total")
+    return {
+        "version": header["source_sha256"],
+        "published": True,
+        "generation": generation,
+        "seconds": round(time.perf_counter() - t0, 3),
+        **diff,
+    }
+
+
+@app.cli.command("build-wordbank")
+@click.option("--force", is_flag=True, help="内容が同じでも作り直す")
+def build_wordbank_command(force):
+    """Excel の単語帳をバイナリにコンパイルする。"""
+    dst = compiled_path(EXCEL_PATH)
+    if build_wordbank(EXCEL_PATH, dst, force=force):
+        click.echo(f"built {dst}")
+    else:
+        click.echo(f"up to date {dst}")
+
+
+def load_sheet_rows(path, sheet):
+    # キャッシュの WordSheet は共有なので書き換えないこと
+    return get_wordbank(path).sheets[sheet]
+
+
+def load_sheet_range(path, sheet, start, end):
+    # 出題に使う範囲の行（pick40 / pick_batch に渡す WordSheet）
+    if WORDBANK_BACKEND == "postgres":
+        return _db_sheet_range(sheet, start, end)
+    return load_sheet_rows(path, sheet)
+
+
+# ===== 単語帳（Postgres） =====
+# WORDBANK_BACKEND=postgres のときは Excel を読まず、flask import-wordbank で
+# 取り込んだ words テーブルから範囲の行だけを1回の問い合わせで取り出す。
+# 抽選は Python 側（pick40）のままなので、同じ seed なら Excel のときと同じ並びになる
+WORDBANK_BACKEND = os.environ.get("WORDBANK_BACKEND", "excel")
+# 取り込み情報（版・シート名）を読み直す間隔（秒）
+WORDBANK_DB_TTL = float(os.environ.get("WORDBANK_DB_TTL", 30))
+WORDBANK_LOCK_ID = 19_0002
+
+_db_wordbank = None    # (期限, WordBank)
+
+
+def _get_db_wordbank():
+    global _db_wordbank
+    cached = _db_wordbank
+    if cached is not None and time.monotonic() < cached[0]:
+        return cached[1]
+
+    with _wordbank_lock:
+        cached = _db_wordbank
+        if cached is None or time.monotonic() >= cached[0]:
+            ensure_schema()
+            with get_db() as cur:
+                cur.execute("SELECT version, sheetnames FROM wordbank_meta")
+                row = cur.fetchone()
+            if row is None:
+                raise RuntimeError("単語帳が取り込まれていません（flask import-wordbank を実行してください）")
+            # sheets は持たない（範囲は _db_sheet_range で毎回引く）
+            bank = WordBank(None, row[0], list(row[1]), None)
+            cached = _db_wordbank = (time.monotonic() + WORDBANK_DB_TTL, bank)
+    return cached[1]
+
+
+def _db_sheet_range(sheet, start, end):
+    if sheet not in get_wordbank().sheetnames:
+        raise KeyError(sheet)
+    with get_db() as cur:
+        cur.execute(
+            "SELECT num, q, a FROM words"
+            " WHERE sheet = %s AND num BETWEEN %s AND %s ORDER BY num, pos",
+            (sheet, start, end)
+        )
+        rows = cur.fetchall()
+    return WordSheet(rows)
+
+
+def db_sheet_digests():
+    with get_db() as cur:
+        cur.execute("SELECT sheet, sha256 FROM wordbank_sheets")
+        return dict(cur.fetchall())
+
+
+def import_wordbank(path=EXCEL_PATH, force=False):
+    # 1トランザクションで入れ替えるので、取り込み中も読む側は古い版が見える。
+    # シートごとの sha256 を比べ、変わったシート・なくなったシートの行だけを入れ替える
+    version = _file_sha256(path)
+    with get_db() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (WORDBANK_LOCK_ID,))
+        cur.execute("SELECT version FROM wordbank_meta")
+        row = cur.fetchone()
+        if not force and row is not None and row[0] == version:
+            return None
+        cur.execute("SELECT sheet, sha256 FROM wordbank_sheets")
+        old = {} if force else dict(cur.fetchall())
+
+        count = 0
+        replaced = []
+        with open_workbook(path) as wb:
+            sheetnames = list(wb.sheetnames)
+            for ws in wb.worksheets:
+                rows = _parse_rows(ws)
+                _, digest = _encode_sheet(rows)
+                if old.get(ws.title) == digest:
+                    continue
+                cur.execute("DELETE FROM words WHERE sheet = %s", (ws.title,))
+                # 番号のない行は出題されないので入れない
+                values = [
+                    (ws.title, r["num"], pos, r["q"], r["a"])
+                    for pos, r in enumerate(rows) if r["num"] is not None
+                ]
+                execute_values(
+                    cur, "INSERT INTO words (sheet, num, pos, q, a) VALUES %s",
+                    values, page_size=1000
+                )
+                cur.execute(
+                    "INSERT INTO wordbank_sheets (sheet, sha256) VALUES (%s, %s)"
+                    " ON CONFLICT (sheet) DO UPDATE SET sha256 = EXCLUDED.sha256",
+                    (ws.title, digest)
+                )
+                count += len(values)
+                replaced.append(ws.title)
+
+        # なくなったシート（取り込み情報のないまま残った行も含めて）
+        cur.execute("DELETE FROM words WHERE NOT (sheet = ANY(%s))", (sheetnames,))
+        cur.execute("DELETE FROM wordbank_sheets WHERE NOT (sheet = ANY(%s))", (sheetnames,))
+        cur.execute("DELETE FROM wordbank_meta")
+        cur.execute(
+            "INSERT INTO wordbank_meta (version, sheetnames) VALUES (%s, %s)",
+            (version, sheetnames)
+        )
+        if replaced:
+            cur.execute("ANALYZE words")
+    return version, count, replaced
+
+
+@app.cli.command("import-wordbank")
+@click.option("--force", is_flag=True, help="内容が同じでも取り込み直す")
+def import_wordbank_command(force):
+    """Excel の単語帳を Postgres の words テーブルに取り込む。"""
+    for version, name in migrate():
+        click.echo(f"applied {version}: {name}")
+    result = import_wordbank(EXCEL_PATH, force=force)
+    if result is None:
+        click.echo("up to date")
+    else:
+        version, count, replaced = result
+        click.echo(f"imported {count} words from {len(replaced)} sheets (version {version[:12]})")
+
+
+
+def pick40(rows, start, end, seed=None):
+    # seed が同じなら同じ並びになる
+    rng = random if seed is None else random.Random(seed)
+    lo, hi = rows.span(start, end)
+    # 範囲全体はシャッフルせず、位置だけを40個抜き出す
+    picked = rng.sample(range(lo, hi), min(40, max(0, hi - lo)))
+    items = [
+        Word(rows.nums[i], rows.questions[i], rows.answers[i], no)
+        for no, i in enumerate(picked, 1)
+    ]
+    for no in range(len(items) + 1, 41):
+        items.append(Word(None, "", "", no))
+    return items
+
+# 人数分の並びを作る。同じ並びが出たら引き直す（範囲が狭いと重なり得る）
+def pick_batch(rows, start, end, copies, seed):
+    rng = random.Random(seed)
+    item_sets = []
+    seen = set()
+    for _ in range(copies):
+        for _ in range(10):
+            items = pick40(rows, start, end, rng.getrandbits(32))
+            order = tuple(r["num"] for r in items)
+            if order not in seen:
+                break
+        seen.add(order)
+        item_sets.append(items)
+    return item_sets
+
+
+# ===== 文字の折り返し・縮小 =====
+# 文字幅はフォントごとに1文字1回だけ測り（1000 単位）、
+# 折り返しは単位ごとの幅を足し合わせて判定する
+_char_widths = {}
+
+
+def _text_width1000(text, font):
+    widths = _char_widths.get(font)
+    if widths is None:
+        widths = _char_widths.setdefault(font, {})
+    total = 0.0
+    for ch in text:
+        w = widths.get(ch)
+        if w is None:
+            w = widths[ch] = stringWidth(ch, font, 1000)
+        total += w
+    return total
+
+
+@lru_cache(maxsize=4096)
+def _measure(text, font):
+    # (単語区切りか, 単位, 各単位の幅, 区切りの幅)
     if " " in text:
-        units = text.split(" ")
+        units = tuple(text.split(" "))
     else:
-        units = list(text)
+        units = tuple(text)
+    widths = tuple(_text_width1000(u, font) for u in units)
+    return " " in text, units, widths, _text_width1000(" ", font)
+
+
+def _wrap(text, font, size, max_width, max_lines=None):
+    by_word, units, widths, sep_w = _measure(text, font)
 
     lines = []
     current = ""
-
-    for u in units:
-        test = (current + " " + u).strip() if " " in text else (current + u)
-        if stringWidth(test, font, size) <= max_width:
-            current = test
+    cur_w = 0.0
+    clean = True     # current の前後に空白がない（幅を足し算で出せる）
+
+    for u, w in zip(units, widths):
+        if not by_word:
+            test, test_w = current + u, cur_w + w
+        elif clean and current and u and u == u.strip():
+            test, test_w = current + " " + u, cur_w + sep_w + w
+        else:
+            # 空白が続く・端に空白があるなど。文字列から測り直す
+            test = (current + " " + u).strip()
+            test_w = _text_width1000(test, font)
+
+        # stringWidth と同じ式で比べる
+        if 0.001 * size * test_w <= max_width:
+            current, cur_w = test, test_w
+            clean = True
         else:
             lines.append(current)
-            current = u
+            if max_lines is not None and len(lines) > max_lines:
+                return lines
+            current, cur_w = u, w
+            clean = u == u.strip()
 
     if current:
         lines.append(current)
 
     return lines
 
-def draw_text_fitted(c, text, font, base_x, base_y, max_width, max_height):
-    if not text:
-        return
 
+def wrap_text(text, font, size, max_width):
+    return _wrap(text, font, size, max_width)
+
+
+# 同じ単語は何度も出てくるので、決まったサイズと行をキャッシュする
+@lru_cache(maxsize=8192)
+def fit_text(text, font, max_width, max_height):
     for size in range(10, 3, -1):
-        lines = wrap_text(text, font, size, max_width)
+        lines = _wrap(text, font, size, max_width, max_lines=2)
         if len(lines) > 2:
             continue
 
         total_h = len(lines) * size
         if total_h <= max_height:
-            c.setFont(font, size)
-            y = base_y
-            for ln in lines:
-                c.drawString(base_x, y, ln)
-                y -= size + 2
-            return
+            return size, tuple(lines)
+    return None
+
+
+def draw_text_fitted(c, text, font, base_x, base_y, max_width, max_height):
+    if not text:
+        return
+
+    fitted = fit_text(text, font, max_width, max_height)
+    if fitted is None:
+        return
+
+    size, lines = fitted
+    c.setFont(font, size)
+    y = base_y
+    for ln in lines:
+        c.drawString(base_x, y, ln)
+        y -= size + 2
 
 def draw_answer_fitted(c, text, font, base_x, base_y, max_width, max_height):
     draw_text_fitted(c, text, font, base_x, base_y, max_width, max_height)
 
 
 def make_two_page_pdf(items, sheet, start, end):
-    filename = TMPDIR / f"{uuid.uuid4().hex}_final.pdf"
-    c = canvas.Canvas(str(filename), pagesize=landscape(A4))
+    return make_batch_pdf([items], sheet, start, end)
+
+
+# 問題・解答の2ページを人数分、1つのPDFにまとめる
+def make_batch_pdf(item_sets, sheet, start, end):
+    # ディスクには書かず、メモリ上で作ってバイト列で返す
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=landscape(A4))
+    frames = set()
+    for items in item_sets:
+        draw_test_pages(c, items, sheet, start, end, frames)
+    c.save()
+    return buf.getvalue()
+
+
+# ===== ページの配置（どのPDFでも同じなのでプロセスで1回だけ計算） =====
+@lru_cache(maxsize=1)
+def page_layout():
     PW, PH = landscape(A4)
 
     margin = 15*mm
@@ -1566,83 +2680,109 @@ def make_two_page_pdf(items, sheet, start, end):
 
     left_x = margin
     right_x = left_x + col_w + col_gap
+
+    title_y  = PH - 10*mm
+    words_y  = title_y - 10*mm
+    start_y  = words_y - 14*mm
+
+    rows_per_col = 20
+    bottom = 12*mm
+    avail_h = start_y - bottom
+    line_h = avail_h / rows_per_col
+    if line_h > 12*mm: line_h = 12*mm
+    if line_h < 9*mm:  line_h = 9*mm
+
+    return SimpleNamespace(
+        PW=PW, PH=PH, margin=margin, col_w=col_w,
+        left_x=left_x, right_x=right_x,
+        title_y=title_y, words_y=words_y, start_y=start_y,
+        rows_per_col=rows_per_col, line_h=line_h,
+        # ▼ 幅設定（安全マージン）
+        question_width=col_w * 0.50,    # 問題の横幅
+        answer_width=col_w * 0.40,      # 解答の横幅
+        margin_between=col_w * 0.10,    # 問題〜解答の間隔
+        # ▼ 高さを3行分確保
+        max_h=line_h * 3.2,
+    )
+
+
+# ===== ページ枠（タイトル・名前欄・番号・解答線） =====
+# 問題ごとに変わらない部分は Form XObject として1つのPDFにつき1回だけ描き、
+# 各ページからは名前で参照する（クラス分印刷では全ページで共有される）
+def draw_page_frame(c, mode_label, sheet, start, end, count):
+    L = page_layout()
+
+    c.setFont(DEFAULT_FONT, 16)
+    c.drawString(L.left_x, L.title_y, "shingaku19minato test")
+
+    c.setFont(DEFAULT_FONT, 12)
+    c.drawString(L.left_x, L.words_y, f"words  {sheet}（{start}～{end}）")
+
+    # ←★ これを忘れずに入れる
+    c.setFont(DEFAULT_FONT, 12)
+    c.drawString(L.PW - L.margin - 170, L.title_y, "name：________________")
+    c.drawString(L.PW - L.margin - 170, L.title_y - 8*mm, "score：________________")
+
+    for idx0, base_x in ((0, L.left_x), (L.rows_per_col, L.right_x)):
+        for i in range(L.rows_per_col):
+            if idx0+i >= count: break
+            y = L.start_y - i * L.line_h
+
+            # 番号
+            c.setFont(DEFAULT_FONT, 10)
+            c.drawString(base_x, y, f"{idx0 + i + 1}.")
+
+            if mode_label == "q":
+                lx1 = base_x + 10*mm + L.question_width + 2*mm
+                lx2 = base_x + L.col_w - 5*mm
+                c.setLineWidth(0.5)
+                c.line(lx1, y - 3, lx2, y - 3)
+
+
+def draw_test_pages(c, items, sheet, start, end, frames=None):
+    L = page_layout()
+    if frames is None:
+        frames = set()
+
     # ====== ページ描画 ======
     def draw_page(mode_label):
-        title_y  = PH - 10*mm
-        words_y  = title_y - 10*mm
-        start_y  = words_y - 14*mm
-
-        c.setFont(DEFAULT_FONT, 16)
-        c.drawString(left_x, title_y, "shingaku19minato test")
-        
-        c.setFont(DEFAULT_FONT, 12)
-        c.drawString(left_x, words_y, f"words  {sheet}（{start}～{end}）")
-        
-        # ←★ これを忘れずに入れる
-        c.setFont(DEFAULT_FONT, 12)
-        c.drawString(PW - margin - 170, title_y, "name：________________")
-        c.drawString(PW - margin - 170, title_y - 8*mm, "score：________________")
-
-        rows_per_col = 20
-        bottom = 12*mm
-        avail_h = start_y - bottom
-        line_h = avail_h / rows_per_col
-        if line_h > 12*mm: line_h = 12*mm
-        if line_h < 9*mm:  line_h = 9*mm
-
-
-        # ===== 20行の表を2列に描く =====
+        name = f"frame_{mode_label}_{len(items)}"
+        if name not in frames:
+            c.beginForm(name)
+            draw_page_frame(c, mode_label, sheet, start, end, len(items))
+            c.endForm()
+            frames.add(name)
+        c.doForm(name)
+
+        # ===== 20行の表を2列に描く（問題ごとに変わる文字だけ） =====
         def draw_col(base_x, idx0):
-            for i in range(rows_per_col):
+            for i in range(L.rows_per_col):
                 if idx0+i >= len(items): break
                 r = items[idx0+i]
-        
-                y = start_y - i * line_h
-        
-                # 番号
-                c.setFont(DEFAULT_FONT, 10)
-                c.drawString(base_x, y, f"{r['no']}.")
-        
-                # ▼ 幅設定（安全マージン）
-                question_width = col_w * 0.50    # 問題の横幅
-                answer_width   = col_w * 0.40    # 解答の横幅
-                margin_between = col_w * 0.10    # 問題〜解答の間隔
-        
+
+                y = L.start_y - i * L.line_h
                 qx = base_x + 10*mm
-        
-                # ▼ 高さを3行分確保
-                max_h = line_h * 3.2
-        
+
                 # ▼ 問題
                 draw_text_fitted(
                     c, r['q'], DEFAULT_FONT,
                     qx, y,
-                    question_width,
-                    max_h
+                    L.question_width,
+                    L.max_h
                 )
-        
-                if mode_label == "q":
-                    lx1 = qx + question_width + 2*mm
-                    lx2 = base_x + col_w - 5*mm
-                    c.setLineWidth(0.5)
-                    c.line(lx1, y - 3, lx2, y - 3)
-                else:
+
+                if mode_label == "a":
                     # ▼ 解答（右に寄せる）
-                    ax = base_x + question_width + margin_between
-                    # 修正: draw_text_fitted から draw_answer_fitted に変更
-                    draw_answer_fitted( 
+                    ax = base_x + L.question_width + L.margin_between
+                    draw_answer_fitted(
                         c, r['a'], DEFAULT_FONT,
                         ax, y,
-                        answer_width,
-                        max_h
+                        L.answer_width,
+                        L.max_h
                     )
 
-
-
-        
-
-        draw_col(left_x, 0)
-        draw_col(right_x, 20)
+        draw_col(L.left_x, 0)
+        draw_col(L.right_x, L.rows_per_col)
 
         c.showPage()
 
@@ -1653,10 +2793,258 @@ def make_two_page_pdf(items, sheet, start, end):
     # ===== 2ページ目：解答 =====
     draw_page("a")
 
-    c.save()
-    return filename
 
 
 
 
 
+
+
+# ===== PDFキャッシュ =====
+# メモリ上の LRU（合計バイト数で上限）。dir を渡すとディスクにも置く
+class BytesLRU:
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_size = 0
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_size = sum(size for _, size, _ in self._disk_files())
+
+    def _disk_path(self, key):
+        name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return self.disk_dir / f"{name}.bin"
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                return data
+
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)    # ディスク側も最近使った順にする
+        except OSError:
+            return None
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+        if self.disk_dir:
+            self._put_disk(key, data)
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, dropped = self._items.popitem(last=False)
+                self._size -= len(dropped)
+
+    def _put_disk(self, key, data):
+        path = self._disk_path(key)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        try:
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+
+        # 書いた分を足していき、上限を超えたときだけディレクトリを数え直して
+        # 古いものから 9 割まで消す（毎回 glob と stat をしない）。
+        # 他のワーカーが書いた分は数え直すまで見えないので、少しは上限を超え得る
+        with self._disk_lock:
+            self._disk_size += len(data)
+            if self._disk_size <= self.disk_max_bytes:
+                return
+            files = self._disk_files()
+            total = sum(size for _, size, _ in files)
+            low = self.disk_max_bytes * 9 // 10
+            for _, size, p in sorted(files, key=lambda f: f[0]):
+                if total <= low:
+                    break
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+                total -= size
+            self._disk_size = total
+
+    def _disk_files(self):
+        files = []
+        for p in self.disk_dir.glob("*.bin"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        return files
+
+
+pdf_cache = BytesLRU(
+    max_bytes=int(os.environ.get("PDF_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+    disk_dir=private_dir(os.environ["PDF_CACHE_DIR"]) if os.environ.get("PDF_CACHE_DIR") else None,
+    disk_max_bytes=int(os.environ.get("PDF_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024)),
+)
+
+
+# ===== PDF描画用プロセスプール =====
+# ReportLab の描画は別プロセスで行い、gunicorn のワーカーを塞がない。
+# プールはワーカーごと（fork 後）に作る。
+# スレッドが動いているワーカーから fork すると、他のスレッドが持っていたロックを
+# 子が握ったままになり得るので、Linux では forkserver を使う（app を読み込んだ
+# サーバーから子を作るので、子の起動は速い）
+PDF_MP_START = os.environ.get("PDF_MP_START") or (
+    "forkserver" if sys.platform.startswith("linux") else None
+)
+
+
+class PdfBusy(Exception):
+    pass
+
+
+_pdf_pool = None
+_pdf_pool_pid = None
+_pdf_slots = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool():
+    global _pdf_pool, _pdf_pool_pid, _pdf_slots
+    if _pdf_pool_pid != os.getpid():
+        with _pdf_pool_lock:
+            if _pdf_pool_pid != os.getpid():
+                ctx = multiprocessing.get_context(PDF_MP_START) if PDF_MP_START else None
+                if PDF_MP_START == "forkserver":
+                    ctx.set_forkserver_preload([__name__])
+                _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=ctx)
+                _pdf_slots = threading.BoundedSemaphore(PDF_QUEUE_LIMIT)
+                _pdf_pool_pid = os.getpid()
+    return _pdf_pool, _pdf_slots
+
+
+def _reset_pdf_pool():
+    global _pdf_pool_pid
+    with _pdf_pool_lock:
+        _pdf_pool_pid = None
+
+
+def render_pdf(fn, *args):
+    if PDF_WORKERS <= 0:
+        return fn(*args)
+
+    pool, slots = _get_pdf_pool()
+    # 描画中＋待ちが上限なら並ばせずに断る
+    if not slots.acquire(blocking=False):
+        stat_add("pdf_pool_rejected_total")
+        raise PdfBusy()
+
+    try:
+        fut = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        slots.release()
+        _reset_pdf_pool()
+        raise PdfBusy()
+    # 枠は描画が終わった時点で返す（タイムアウトで諦めた場合も）
+    fut.add_done_callback(lambda f: slots.release())
+
+    try:
+        return fut.result(timeout=PDF_TIMEOUT)
+    except FuturesTimeout:
+        fut.cancel()
+        stat_add("pdf_pool_timeouts_total")
+        raise PdfBusy()
+    except BrokenProcessPool:
+        _reset_pdf_pool()
+        raise PdfBusy()
+
+
+@app.errorhandler(HashBusy)
+def hash_busy(e):
+    return (
+        "混み合っています。少し待ってからもう一度お試しください",
+        503,
+        {"Retry-After": "2"},
+    )
+
+
+@app.errorhandler(PdfBusy)
+def pdf_busy(e):
+    return (
+        "混み合っています。少し待ってからもう一度お試しください",
+        503,
+        {"Retry-After": str(PDF_RETRY_AFTER)},
+    )
+
+
+# ===== レスポンス圧縮 =====
+# HTML / PDF などを Accept-Encoding に合わせて br / gzip で返す。
+# キャッシュから返すレスポンス（g.cache_key あり）は圧縮結果も覚えておき、
+# 同じ中身を2回圧縮しない
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+COMPRESS_MIMETYPES = {
+    "text/html", "text/plain", "application/json", "application/pdf",
+}
+
+compressed_cache = BytesLRU(
+    max_bytes=int(os.environ.get("COMPRESS_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+)
+
+
+def compress_body(data, enc):
+    if enc == "br":
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, 6)
+
+
+@app.after_request
+def compress_response(res):
+    if (res.status_code != 200 or res.direct_passthrough
+            or "Content-Encoding" in res.headers
+            or res.mimetype not in COMPRESS_MIMETYPES):
+        return res
+
+    res.vary.add("Accept-Encoding")
+    data = res.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return res
+    enc = negotiate_encoding({"br", "gzip"} if brotli is not None else {"gzip"})
+    if enc is None:
+        return res
+
+    key = g.get("cache_key")
+    body = compressed_cache.get((key, enc)) if key is not None else None
+    if body is None:
+        with timed("compress"):
+            body = compress_body(data, enc)
+        if key is not None:
+            compressed_cache.put((key, enc), body)
+    else:
+        stat_add("compress_cache_hits_total")
+    if len(body) >= len(data):
+        return res
+
+    stat_add("compress_bytes_in_total", len(data))
+    stat_add("compress_bytes_out_total", len(body))
+    res.set_data(body)
+    res.headers["Content-Encoding"] = enc
+    # 圧縮の有無で中身のバイト列が変わるので、強い ETag は弱い ETag にする
+    etag, weak = res.get_etag()
+    if etag and not weak:
+        res.set_etag(etag, weak=True)
+    return res
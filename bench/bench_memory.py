@@ -0,0 +1,85 @@
+# Excel の読み込みにかかるメモリ（tracemalloc のピーク）と時間を比べる
+#   full      : load_workbook(data_only=True) でブック全体を読み、1シートを取り出す（以前のやり方）
+#   streaming : read_sheet_rows（読み取り専用モードで1シートだけを流し読み）
+#   build     : build_wordbank（全シートを1枚ずつ流し読みしてバイナリにする）
+#
+#   python bench/bench_memory.py [--sheets 10 --rows 10000]
+#
+# 時間は tracemalloc を有効にした状態のもの（比べる目安。実際はもっと速い）。
+# 大きな単語帳を作って測る（同梱の Excel は使わない）。DB には接続しない
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+from openpyxl import Workbook, load_workbook  # noqa: E402
+
+import app as wordtest  # noqa: E402
+
+
+def make_workbook(path, sheets, rows):
+    # write_only で作るので、作る側のメモリは増えない
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    wb = Workbook(write_only=True)
+    for s in range(sheets):
+        ws = wb.create_sheet(f"sheet{s:02d}")
+        ws.append(["番号", "問題", "解答"])
+        for i in range(1, rows + 1):
+            word = "".join(rng.choice(letters) for _ in range(rng.randint(4, 12)))
+            ws.append([i, f"{word} の意味は？", f"答え{s}-{i}"])
+    wb.save(path)
+
+
+def measure(fn):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, peak
+
+
+def full_load(path, sheet):
+    wb = load_workbook(str(path), data_only=True)
+    return wordtest._parse_rows(wb[sheet])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sheets", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "large.xlsx"
+        t0 = time.perf_counter()
+        make_workbook(path, args.sheets, args.rows)
+        print(f"{args.sheets} sheets x {args.rows} rows, "
+              f"{path.stat().st_size / 1e6:.1f} MB ({time.perf_counter() - t0:.1f} s to write)")
+
+        sheet = "sheet00"
+        cases = [
+            ("full (1 sheet)", lambda: full_load(path, sheet)),
+            ("streaming (1 sheet)", lambda: wordtest.read_sheet_rows(path, sheet)),
+            ("build_wordbank (all)", lambda: wordtest.build_wordbank(path, Path(tmp) / "large.wordbank", force=True)),
+        ]
+        for label, fn in cases:
+            elapsed, peak = measure(fn)
+            print(f"{label:22s} {elapsed:8.2f} s   peak {peak / 1e6:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
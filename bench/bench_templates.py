@@ -0,0 +1,63 @@
+# /generate_html_test のテンプレート描画時間を比べる
+#   before: render_template_string（毎回パースとコンパイル）
+#   after : render_template（起動時に登録したコンパイル済みテンプレート）
+#
+#   python bench/bench_templates.py [-n 200]
+#
+# DB には接続しない（DATABASE_URL は未設定でよい）
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(ROOT)
+
+from flask import render_template, render_template_string  # noqa: E402
+
+import app as wordtest  # noqa: E402
+
+
+def timeit(fn, n):
+    fn()    # 1回目（キャッシュ作成）は除く
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=200, help="繰り返し回数")
+    parser.add_argument("--sheet", default=None)
+    args = parser.parse_args()
+
+    bank = wordtest.get_wordbank(wordtest.EXCEL_PATH)
+    sheet = args.sheet or bank.sheetnames[0]
+    items = wordtest.pick40(bank.sheets[sheet], 1, 100, seed=1)
+    ctx = dict(items=items, sheet=sheet, start=1, end=100)
+
+    with wordtest.app.test_request_context():
+        before = timeit(
+            lambda: render_template_string(wordtest.HTML_TEST_TEMPLATE, **ctx), args.n
+        )
+        after = timeit(
+            lambda: render_template("app/html_test.html", **ctx), args.n
+        )
+
+    # ルート全体（セッションを直接入れてログインを飛ばす）
+    client = wordtest.app.test_client()
+    with client.session_transaction() as s:
+        s["user_id"] = 0
+    body = {"sheet": sheet, "start": 1, "end": 100, "seed": 1}
+    route = timeit(lambda: client.post("/generate_html_test", json=body), args.n)
+
+    print(f"render_template_string : {before:8.3f} ms/回")
+    print(f"render_template        : {after:8.3f} ms/回  ({before / after:.1f}x)")
+    print(f"POST /generate_html_test: {route:8.3f} ms/回")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# 複数クライアントから HTTP で負荷をかけ、スループットと遅延を測る
+#
+#   # 起動済みのサーバーに対して
+#   python bench/loadtest.py --url http://127.0.0.1:10000 --clients 16 --duration 20
+#
+#   # サーバーを順に起動して比べる（{port} は空いているポートに置き換わる）
+#   python bench/loadtest.py \
+#       --server "gunicorn app:app --bind 127.0.0.1:{port}" \
+#       --server "gunicorn -c gunicorn.conf.py app:app"
+#
+# ログインは SECRET_KEY でセッション Cookie を作って飛ばすので DB は要らない
+# （サーバーと同じ SECRET_KEY を環境変数で渡すこと）。
+import argparse
+import http.client
+import json
+import os
+import shlex
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def session_cookie(user_id=1, role="student"):
+    # app と同じ方法で署名したセッション Cookie を作る
+    from flask import Flask
+
+    app = Flask("loadtest")
+    app.secret_key = os.environ.get("SECRET_KEY", "dev-secret")
+    s = app.session_interface.get_signing_serializer(app)
+    return "session=" + s.dumps({"user_id": user_id, "role": role})
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def run_load(url, requests, clients, duration, cookie):
+    # requests: [(method, path, body dict or None), ...] を順に回す
+    parts = urlsplit(url)
+    latencies = []
+    by_path = {}
+    statuses = {}
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(idx):
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        n = idx
+        while time.perf_counter() < deadline:
+            method, path, body = requests[n % len(requests)]
+            n += 1
+            headers = {"Cookie": cookie, "Accept-Encoding": "gzip, br"}
+            data = None
+            if body is not None:
+                data = json.dumps(body).encode("utf-8")
+                headers["Content-Type"] = "application/json"
+            t0 = time.perf_counter()
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                res = conn.getresponse()
+                res.read()
+                status = res.status
+                if res.getheader("Connection", "").lower() == "close":
+                    conn.close()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+                with lock:
+                    errors.append(repr(e))
+                continue
+            elapsed = time.perf_counter() - t0
+            with lock:
+                latencies.append(elapsed)
+                by_path.setdefault(f"{method} {path}", []).append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+        conn.close()
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t_start
+
+    latencies.sort()
+    ok = sum(v for k, v in statuses.items() if 200 <= k < 300)
+    return {
+        "requests": len(latencies),
+        "ok": ok,
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "seconds": round(wall, 3),
+        "rps": round(ok / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        # 重いページと軽いページを分けて見る（軽いページが待たされていないか）
+        "by_path": {
+            key: {
+                "requests": len(v),
+                "p50_ms": round(percentile(sorted(v), 50) * 1000, 2),
+                "p95_ms": round(percentile(sorted(v), 95) * 1000, 2),
+                "p99_ms": round(percentile(sorted(v), 99) * 1000, 2),
+            }
+            for key, v in sorted(by_path.items())
+        },
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+def start_server(cmd):
+    port = free_port()
+    env = {**os.environ, "PORT": str(port)}
+    proc = subprocess.Popen(
+        shlex.split(cmd.format(port=port)), cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    wait_until_up(port, proc)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def stop_server(proc):
+    os.killpg(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
+def default_requests(sheet, start, end):
+    body = {"sheet": sheet, "start": start, "end": end}
+    return [
+        ("POST", "/generate", body),
+        ("POST", "/generate_html_test", body),
+        ("GET", "/", None),
+    ]
+
+
+def print_result(label, r):
+    print(f"{label}")
+    print(f"  {r['requests']} req / {r['seconds']} s  -> {r['rps']} req/s"
+          f"  (errors {r['errors']}, status {r['statuses']})")
+    print(f"  p50 {r['p50_ms']} ms  p95 {r['p95_ms']} ms  p99 {r['p99_ms']} ms")
+    for key, p in r["by_path"].items():
+        print(f"    {key:28s} p50 {p['p50_ms']:8.2f} ms  p95 {p['p95_ms']:8.2f} ms  p99 {p['p99_ms']:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:10000")
+    parser.add_argument("--server", action="append", default=[],
+                        help="起動して測るコマンド（複数指定で比較）")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--sheet", default="perfect1170")
+    parser.add_argument("--start", type=int, default=1)
+    parser.add_argument("--end", type=int, default=500)
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    cookie = session_cookie()
+    requests = default_requests(args.sheet, args.start, args.end)
+
+    results = {}
+    if args.server:
+        for cmd in args.server:
+            proc, url = start_server(cmd)
+            try:
+                run_load(url, requests, 2, 2, cookie)    # 暖機
+                results[cmd] = run_load(url, requests, args.clients, args.duration, cookie)
+            finally:
+                stop_server(proc)
+            print_result(cmd, results[cmd])
+    else:
+        results[args.url] = run_load(args.url, requests, args.clients, args.duration, cookie)
+        print_result(args.url, results[args.url])
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
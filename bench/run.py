@@ -0,0 +1,192 @@
+# ベンチマーク一式
+#   1. 関数ごとの計測（単語帳の読み込み・pick40・折り返し・PDF作成）
+#   2. gunicorn を起動しての HTTP 負荷テスト（p50 / p95 / p99）
+# 結果は JSON に書き出すので、前回の結果と比べて劣化を見つけられる。
+#
+#   python bench/run.py                        # 全部
+#   python bench/run.py --no-http              # 関数だけ
+#   python bench/run.py --compare bench/results/前回.json
+#
+# 単語帳は同梱の 英単語テスト.xlsx を使う。ログインは署名したセッション
+# Cookie で飛ばし、計測するページは DB を使わないので Postgres は要らない。
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+BENCH = Path(__file__).resolve().parent
+ROOT = BENCH.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(BENCH))
+os.chdir(ROOT)
+
+import loadtest  # noqa: E402
+
+
+def bench(fn, min_time=1.0, min_runs=5, setup=None):
+    # min_time 秒かつ min_runs 回以上まわし、1回あたりの時間を返す
+    times = []
+    t_end = time.perf_counter() + min_time
+    while len(times) < min_runs or time.perf_counter() < t_end:
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return {
+        "runs": len(times),
+        "min_ms": round(times[0] * 1000, 4),
+        "median_ms": round(times[len(times) // 2] * 1000, 4),
+        "mean_ms": round(sum(times) / len(times) * 1000, 4),
+    }
+
+
+def micro(sheet, start, end, min_time):
+    import app as wordtest
+    from reportlab.pdfgen import canvas
+
+    path = wordtest.EXCEL_PATH
+    compiled = wordtest.compiled_path(path)
+    results = {}
+
+    # 単語帳：Excel からのコンパイル / バイナリからの読み込み / キャッシュ済み
+    results["build_wordbank"] = bench(
+        lambda: wordtest.build_wordbank(path, force=True), min_time, min_runs=3)
+    results["load_compiled_wordbank"] = bench(
+        lambda: wordtest.load_compiled_wordbank(compiled), min_time)
+    wordtest.get_wordbank(path)
+    results["load_sheet_rows"] = bench(
+        lambda: wordtest.load_sheet_rows(path, sheet), min_time)
+
+    rows = wordtest.load_sheet_rows(path, sheet)
+    results["pick40"] = bench(lambda: wordtest.pick40(rows, start, end), min_time)
+
+    items = wordtest.pick40(rows, start, end, seed=1)
+    texts = [r["q"] for r in items] + [r["a"] for r in items]
+    font = wordtest.DEFAULT_FONT
+    L = wordtest.page_layout()
+
+    def clear_text_caches():
+        wordtest._char_widths.clear()
+        wordtest._measure.cache_clear()
+        wordtest.fit_text.cache_clear()
+
+    # 折り返し：文字幅のキャッシュが空の状態と、温まった状態
+    results["wrap_text_cold"] = bench(
+        lambda: [wordtest.wrap_text(t, font, 10, L.question_width) for t in texts],
+        min_time, setup=clear_text_caches)
+    results["wrap_text_warm"] = bench(
+        lambda: [wordtest.wrap_text(t, font, 10, L.question_width) for t in texts],
+        min_time)
+
+    def fit_all():
+        c = canvas.Canvas(os.devnull)
+        for t in texts:
+            wordtest.draw_text_fitted(c, t, font, 0, 0, L.question_width, L.max_h)
+
+    results["draw_text_fitted_cold"] = bench(fit_all, min_time, setup=clear_text_caches)
+    results["draw_text_fitted_warm"] = bench(fit_all, min_time)
+
+    results["make_two_page_pdf"] = bench(
+        lambda: wordtest.make_two_page_pdf(items, sheet, start, end), min_time)
+    item_sets = wordtest.pick_batch(rows, start, end, 30, 1)
+    results["make_batch_pdf_30"] = bench(
+        lambda: wordtest.make_batch_pdf(item_sets, sheet, start, end), min_time, min_runs=3)
+    return results
+
+
+def http(sheet, start, end, clients, duration, server):
+    cookie = loadtest.session_cookie()
+    requests = loadtest.default_requests(sheet, start, end)
+    proc, url = loadtest.start_server(server)
+    try:
+        loadtest.run_load(url, requests, 2, 2, cookie)    # 暖機
+        result = {"mix": loadtest.run_load(url, requests, clients, duration, cookie)}
+        for method, path, body in requests:
+            result[f"{method} {path}"] = loadtest.run_load(
+                url, [(method, path, body)], clients, duration / 2, cookie)
+    finally:
+        loadtest.stop_server(proc)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    # 前回より 10% 以上遅くなったものに印をつける
+    print("\n--- 前回との比較 ---")
+    for name, r in new.get("micro", {}).items():
+        o = old.get("micro", {}).get(name)
+        if not o:
+            continue
+        ratio = r["median_ms"] / o["median_ms"] if o["median_ms"] else 0
+        mark = "  ← 遅くなった" if ratio > 1.10 else ""
+        print(f"{name:26s} {o['median_ms']:10.3f} → {r['median_ms']:10.3f} ms  ({ratio:.2f}x){mark}")
+    for name, r in new.get("http", {}).items():
+        o = old.get("http", {}).get(name)
+        if not o:
+            continue
+        mark = "  ← 遅くなった" if o["p95_ms"] and r["p95_ms"] / o["p95_ms"] > 1.10 else ""
+        print(f"{name:26s} {o['rps']:8.1f} → {r['rps']:8.1f} req/s  "
+              f"p95 {o['p95_ms']:.1f} → {r['p95_ms']:.1f} ms{mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sheet", default="perfect1170")
+    parser.add_argument("--start", type=int, default=1)
+    parser.add_argument("--end", type=int, default=500)
+    parser.add_argument("--min-time", type=float, default=1.0, help="関数ごとの計測時間（秒）")
+    parser.add_argument("--no-http", action="store_true")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--server", default="gunicorn -c gunicorn.conf.py app:app")
+    parser.add_argument("--out", help="JSON の出力先（既定 bench/results/日時.json）")
+    parser.add_argument("--compare", help="比べる前回の JSON")
+    args = parser.parse_args()
+
+    result = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "params": {"sheet": args.sheet, "start": args.start, "end": args.end},
+    }
+
+    result["micro"] = micro(args.sheet, args.start, args.end, args.min_time)
+    for name, r in result["micro"].items():
+        print(f"{name:26s} median {r['median_ms']:10.3f} ms  min {r['min_ms']:10.3f} ms  ({r['runs']} runs)")
+
+    if not args.no_http:
+        result["params"].update(clients=args.clients, duration=args.duration, server=args.server)
+        result["http"] = http(args.sheet, args.start, args.end,
+                              args.clients, args.duration, args.server)
+        for name, r in result["http"].items():
+            print(f"{name:26s} {r['rps']:8.1f} req/s  "
+                  f"p50 {r['p50_ms']:8.2f}  p95 {r['p95_ms']:8.2f}  p99 {r['p99_ms']:8.2f} ms")
+
+    out = Path(args.out) if args.out else (
+        BENCH / "results" / f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, indent=2, ensure_ascii=False))
+    print(f"\nwrote {out}")
+
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
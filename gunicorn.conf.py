@@ -0,0 +1,103 @@
+# gunicorn の本番設定
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# gthread ワーカー（プロセス × スレッド）で動かす。
+# PDF の描画は各ワーカーのプロセスプール、パスワードのハッシュ計算は
+# スレッドプールに任せているので、リクエストのスレッドは待つだけになり、
+# 遅い PDF があってもログインなど軽いページは止まらない。
+#
+# DB の接続プール・PDF/ハッシュ用のプールは app 側で fork 後に
+# ワーカーごとに作るので、preload_app しても master では作られない。
+#
+# ワーカー1つごとに、ワーカー本体（約 55 MB）のほか PDF 用の forkserver・
+# resource tracker・描画プロセスが立ち、合わせて約 110 MB 増える（RSS）。
+# 小さいインスタンスでは WEB_CONCURRENCY・PDF_WORKERS で絞ること。
+# 既定のワーカー数は使える CPU の数（コンテナの割り当てを見る）で、
+# GUNICORN_MAX_WORKERS（既定 4）を超えない
+import math
+import os
+
+
+def available_cpus():
+    # ホストのコア数ではなく、このプロセスが使える CPU の数
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = os.cpu_count() or 1
+    # cgroup の CPU 割り当て（v2: cpu.max、v1: cfs_quota_us / cfs_period_us）
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+    except OSError:
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            quota = "max"
+    if quota not in ("max", "-1"):
+        n = min(n, math.ceil(int(quota) / int(period)))
+    return max(1, n)
+
+
+cpus = available_cpus()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+max_workers = int(os.environ.get("GUNICORN_MAX_WORKERS", 4))
+workers = int(os.environ.get("WEB_CONCURRENCY", min(max(2, cpus), max_workers)))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# アプリ側のプールの大きさを、ここでの並列数に合わせる（環境変数があればそちら）
+# DB は全ワーカー合わせての接続数（DB_MAX_CONNECTIONS）をワーカーで分ける。
+# スレッドより多くは要らない。足りない分のスレッドは空きを待つ。
+# PDF は CPU の数をワーカーで分ける
+db_max_connections = int(os.environ.get("DB_MAX_CONNECTIONS", 20))
+os.environ.setdefault("DB_POOL_MAX", str(max(1, min(threads, db_max_connections // workers))))
+os.environ.setdefault("PDF_WORKERS", str(max(1, cpus // workers)))
+
+# Excel・テンプレート・静的ファイルは master で1回だけ読み、fork で共有する
+preload_app = True
+
+# PDF の待ち時間（PDF_TIMEOUT 既定 30 秒）より長くしておく
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5
+
+# 長く動くワーカーを少しずつ入れ替える（メモリの膨らみ対策）
+max_requests = 2000
+max_requests_jitter = 200
+
+
+def when_ready(server):
+    # 単語帳を master で読んでおき、各ワーカーは fork 時にそれを引き継ぐ
+    import app
+
+    # Postgres の単語帳のときは master で DB につながない（接続は fork 後にワーカーごと）
+    if app.WORDBANK_BACKEND == "excel":
+        app.get_wordbank(app.EXCEL_PATH)
+    # /metrics に前回の起動の値が混ざらないように
+    app.clean_metrics_dir()
+
+
+def post_fork(server, worker):
+    # master が起動時に数えた値（単語帳の読み込みなど）をワーカーに持ち込まない
+    import app
+
+    app.reset_metrics()
+
+
+def worker_exit(server, worker):
+    # 終わる前に最後の値を書き出しておく
+    import app
+
+    app.flush_metrics(force=True)
+
+
+def child_exit(server, worker):
+    # 終わったワーカーの累計は archive.json にまとめ、<pid>.json は消す
+    import app
+
+    app.archive_worker_metrics(worker.pid)
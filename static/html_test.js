@@ -0,0 +1,287 @@
+console.log("content-layer =", document.getElementById("content-layer"));
+
+let mode = "pen";
+let color = "#000";
+
+function setColor(c){
+  color = (c === "red") ? "#d00" : "#000";
+  mode = "pen";
+}
+
+function setMode(m){
+  mode = m;
+}
+
+function clearAll(){
+  document.querySelectorAll("canvas").forEach(c=>{
+    const ctx = c.getContext("2d");
+    ctx.save();
+    ctx.setTransform(1,0,0,1,0,0);  // ← スケール解除
+    ctx.clearRect(0, 0, c.width, c.height);
+    ctx.restore();
+  });
+}
+
+
+function toggleAll(){
+  document.querySelectorAll('.answer')
+    .forEach(a => a.classList.toggle('show'));
+}
+
+
+document.querySelectorAll("canvas").forEach(c => {
+
+  if (window.matchMedia("print").matches) return;
+
+  const ratio = window.devicePixelRatio || 1;
+
+  // ===== ① CSSサイズを保存（テンプレそのまま）=====
+  const cssW = c.width;
+  const cssH = c.height;
+
+  // ===== ② 内部解像度だけ拡大 =====
+  c.width  = cssW * ratio;
+  c.height = cssH * ratio;
+
+  // ===== ③ 見た目サイズは固定 =====
+  c.style.width  = cssW + "px";
+  c.style.height = cssH + "px";
+
+  const ctx = c.getContext("2d");
+
+  // ★ ここが最重要（座標系を元に戻す）
+  ctx.setTransform(ratio, 0, 0, ratio, 0, 0);
+
+
+  let drawing = false;
+
+  ctx.lineWidth = 0.6;        // ← 今まで通りでOK
+  ctx.lineCap = "round";
+  ctx.lineJoin = "round";
+  ctx.strokeStyle = color;
+
+function getPos(e){
+  const rect = c.getBoundingClientRect();
+  return {
+    x: (e.clientX - rect.left) / scale,
+    y: (e.clientY - rect.top ) / scale
+  };
+}
+
+
+  c.addEventListener("touchstart", e=>{
+    e.preventDefault();
+  }, { passive: false });
+
+  c.addEventListener("pointerdown", e=>{
+    e.preventDefault();
+    e.stopPropagation();
+
+    drawing = true;
+    c.setPointerCapture(e.pointerId);
+
+    const p = getPos(e);
+    ctx.beginPath();
+    ctx.moveTo(p.x, p.y);
+  });
+
+  c.addEventListener("pointermove", e=>{
+    if(!drawing) return;
+    e.preventDefault();
+
+    const p = getPos(e);
+
+    if(mode === "eraser"){
+      ctx.clearRect(p.x - 6, p.y - 6, 12, 12);
+    }else{
+      ctx.strokeStyle = color;
+      ctx.lineTo(p.x, p.y);
+      ctx.stroke();
+    }
+  });
+
+  c.addEventListener("pointerup", e=>{
+    drawing = false;
+    c.releasePointerCapture(e.pointerId);
+  });
+
+  c.addEventListener("pointercancel", ()=>{
+    drawing = false;
+  });
+});
+
+
+document.querySelectorAll('.answer, .item > div:nth-child(2), .item > div:nth-child(6)')
+  .forEach(el=>{
+    if(el.textContent.length > 30){
+      el.classList.add('small-text');
+    }
+  });
+  
+/* ===== ピンチズーム（最終安定版）===== */
+const scrollLayer  = document.getElementById("scroll-layer");
+const contentLayer = document.getElementById("content-layer");
+
+let startScale = 1;
+let pinchCenter = { x: 0, y: 0 };
+let scale = 1;
+let startDist = null;
+
+function getDistance(t1, t2){
+  const dx = t1.clientX - t2.clientX;
+  const dy = t1.clientY - t2.clientY;
+  return Math.hypot(dx, dy);
+}
+
+function getCenter(t1, t2){
+  return {
+    x: (t1.clientX + t2.clientX) / 2,
+    y: (t1.clientY + t2.clientY) / 2
+  };
+}
+
+
+
+
+/* scroll-layer 基準で最小倍率を決める */
+function getMinScale(){
+  const vw = scrollLayer.clientWidth;
+  const vh = scrollLayer.clientHeight;
+
+  const rect = document
+    .getElementById("print-root")
+    .getBoundingClientRect();
+
+  const sx = vw / rect.width;
+  const sy = vh / rect.height;
+
+  return Math.min(sx, sy);
+}
+
+
+function applyScale(cx, cy){
+  const rect = contentLayer.getBoundingClientRect();
+
+  const ox = (cx - rect.left + scrollLayer.scrollLeft) / scale;
+  const oy = (cy - rect.top  + scrollLayer.scrollTop ) / scale;
+
+  contentLayer.style.transform = `scale(${scale})`;
+  contentLayer.style.width  = (100 / scale) + "%";
+  contentLayer.style.height = (100 / scale) + "%";
+
+  scrollLayer.scrollLeft = ox * scale - (cx - rect.left);
+  scrollLayer.scrollTop  = oy * scale - (cy - rect.top);
+
+  /* ===== 余白込みでスクロール制限 ===== */
+  const PADDING_RIGHT = 340 * scale;
+  const PADDING_BOTTOM = 120 * scale;
+
+  const minLeft = 0;
+  const minTop  = 0;
+
+  const maxLeft =
+    contentLayer.scrollWidth - scrollLayer.clientWidth + PADDING_RIGHT;
+  const maxTop =
+    contentLayer.scrollHeight - scrollLayer.clientHeight + PADDING_BOTTOM;
+
+  scrollLayer.scrollLeft = Math.min(maxLeft, Math.max(minLeft, scrollLayer.scrollLeft));
+  scrollLayer.scrollTop  = Math.min(maxTop,  Math.max(minTop,  scrollLayer.scrollTop));
+}
+
+// ===== 初期表示（必須）=====
+const INITIAL_SCALE_FACTOR = 0.55;
+
+window.addEventListener("load", () => {
+  scale = getMinScale() * INITIAL_SCALE_FACTOR;
+
+  // ★ 初期表示は transform だけ設定（補正しない）
+  contentLayer.style.transformOrigin = "0 0";
+  contentLayer.style.transform = `scale(${scale})`;
+
+  // ★ スクロールは必ず左上
+  scrollLayer.scrollLeft = 0;
+  scrollLayer.scrollTop  = 0;
+});
+
+
+
+// ===== 印刷時スケール制御 =====
+let savedScale = 1;
+
+window.addEventListener("beforeprint", () => {
+  savedScale = scale;
+  scale = 1;
+
+  applyScale(0, 0);
+
+  scrollLayer.scrollLeft = 0;
+  scrollLayer.scrollTop  = 0;
+});
+
+window.addEventListener("afterprint", () => {
+  scale = savedScale;
+
+  applyScale(0, 0);
+
+  scrollLayer.scrollLeft = 0;
+  scrollLayer.scrollTop  = 0;
+});
+
+scrollLayer.addEventListener("touchstart", e => {
+  if (e.touches.length === 2) {
+    startDist = getDistance(e.touches[0], e.touches[1]);
+    startScale = scale;
+    pinchCenter = getCenter(e.touches[0], e.touches[1]);
+  }
+}, { passive: false });
+
+
+scrollLayer.addEventListener("touchmove", e => {
+  if (e.touches.length === 2) {
+    e.preventDefault();   // ← ブラウザのズームだけ止める
+    e.stopPropagation(); // ← 追加（暴走防止）
+
+    const newDist = getDistance(e.touches[0], e.touches[1]);
+    const ratio = newDist / startDist;
+    const minScale = getMinScale();
+
+    // ★ 毎回「今の指の中点」を使う
+    const center = getCenter(e.touches[0], e.touches[1]);
+
+    scale = Math.min(3, Math.max(minScale, startScale * ratio));
+    applyScale(center.x, center.y);
+
+
+  }
+}, { passive: false });
+
+scrollLayer.addEventListener("touchend", e => {
+  if (e.touches.length < 2) {
+    startDist = null;
+  }
+}, { passive: false });
+
+scrollLayer.addEventListener("touchcancel", () => {
+  startDist = null;
+}, { passive: false });
+
+
+
+// 初期状態：画面にちょうどフィット
+scale = getFitScale();
+applyScale(scrollLayer.clientWidth / 2, scrollLayer.clientHeight / 2);
+
+// 左上から表示（変な位置防止）
+scrollLayer.scrollLeft = 0;
+scrollLayer.scrollTop  = 0;
+
+function getFitScale(){
+  const vw = scrollLayer.clientWidth;
+  const vh = scrollLayer.clientHeight;
+
+  const rect = contentLayer.getBoundingClientRect();
+  const sx = vw / rect.width;
+  const sy = vh / rect.height;
+
+  return Math.min(sx, sy);
+}